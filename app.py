@@ -1,177 +1,2774 @@
-from flask import Flask, request, send_file, jsonify, render_template, url_for, abort, make_response
+import time
+_import_started = time.perf_counter()  # Medição do tempo de importação do módulo
+
+from flask import Flask, request, send_file, jsonify, render_template, url_for, abort, make_response, g, stream_with_context
 import os
-from rembg import remove
-from PIL import Image
+from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError
+import numpy as np
 import io
+import csv
 import uuid
+import base64
+import zipfile
 import logging
-import time
 import hashlib
 import secrets
 import functools
+import contextlib
+import threading
+import queue
+import sqlite3
+import multiprocessing
+import signal
+import sys
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits.storage import Storage
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import FileStorage
 from logging.handlers import RotatingFileHandler
 import json
+import math
+import socket
+import tempfile
+import ipaddress
+import requests
 from datetime import datetime
-import pkg_resources
+from urllib.parse import urlparse, urljoin
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from importlib.metadata import version as package_version
 
-# Configuração inicial da remoção de fundo
-rembg_version = pkg_resources.get_distribution("rembg").version
-try:
-    # A maioria das versões do rembg usa a função remove diretamente
-    # sem necessidade de inicialização de sessão
-    REMBG_SESSION = None
-    logging.info(f"Rembg inicializado com sucesso (versão {rembg_version})")
-except Exception as e:
-    logging.error(f"Erro ao inicializar rembg: {str(e)}")
-    REMBG_SESSION = None
-
-# Função para limpar arquivos antigos
-def cleanup_old_files(directory, max_age_hours=24):
-    """Remove arquivos mais antigos que max_age_hours do diretório especificado"""
+# Métricas no formato do Prometheus. Com o Gunicorn, PROMETHEUS_MULTIPROC_DIR (definido em
+# gunicorn_config.py) faz cada processo gravar suas métricas em arquivos agregados por /metrics
+if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+)
+
+STAGE_SECONDS = Histogram(
+    'rembg_stage_seconds', 'Tempo de cada etapa do processamento de imagens', ['stage'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    'rembg_queue_wait_seconds', 'Tempo de espera em fila antes do processamento', ['queue'],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, 30, 120, 600)
+)
+REQUEST_SIZE_BYTES = Histogram(
+    'rembg_request_size_bytes', 'Tamanho do corpo das requisições', ['endpoint'],
+    buckets=(10e3, 50e3, 100e3, 250e3, 500e3, 1e6, 2e6, 4e6, 8e6, 16e6)
+)
+REQUEST_PEAK_MEMORY_BYTES = Histogram(
+    'rembg_request_peak_memory_bytes', 'Pico de memória acrescentado pelo processamento de uma requisição', ['endpoint'],
+    buckets=tuple(mb * 1024 * 1024 for mb in (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096))
+)
+IMAGE_MEGAPIXELS = Histogram(
+    'rembg_image_megapixels', 'Resolução das imagens recebidas, em megapixels',
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 6.25, 9, 12, 16, 25, 36)
+)
+REQUESTS_TOTAL = Counter('rembg_http_requests_total', 'Requisições HTTP por rota e status', ['endpoint', 'method', 'status'])
+CACHE_LOOKUPS_TOTAL = Counter('rembg_cache_lookups_total', 'Consultas ao cache de resultados', ['result'])
+SECURITY_EVENTS_TOTAL = Counter('rembg_security_events_total', 'Eventos de segurança por tipo', ['event_type'])
+
+# Medição do tempo de cada etapa do processamento, por thread (ver Server-Timing e benchmark.py)
+_stage_timings = threading.local()
+
+def start_stage_timings():
+    """Inicia uma nova medição de etapas para a thread atual e retorna o dicionário de tempos"""
+    _stage_timings.current = {}
+    _stage_timings.peak_memory = None
+    return _stage_timings.current
+
+def get_stage_timings():
+    """Retorna os tempos (em segundos) acumulados por etapa na thread atual"""
+    return getattr(_stage_timings, 'current', None) or {}
+
+@contextlib.contextmanager
+def timed_stage(name, observe=True):
+    """Acumula o tempo do bloco na etapa indicada, se houver uma medição ativa.
+    
+    Com observe, o tempo também é registrado no histograma rembg_stage_seconds.
+    """
+    start = time.perf_counter()
     try:
-        now = time.time()
-        count = 0
-        
-        for filename in os.listdir(directory):
-            filepath = os.path.join(directory, filename)
-            
-            # Pular diretórios
-            if os.path.isdir(filepath):
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = getattr(_stage_timings, 'current', None)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+        if observe:
+            STAGE_SECONDS.labels(stage=name).observe(elapsed)
+
+def process_memory():
+    """Memória do processo em bytes, de /proc/self/status: rss, anon (RssAnon) e peak (VmHWM).
+    
+    Retorna um dicionário vazio fora do Linux.
+    """
+    fields = {'VmRSS:': 'rss', 'RssAnon:': 'anon', 'VmHWM:': 'peak'}
+    memory = {}
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name, *values = line.split()
+                if name in fields:
+                    memory[fields[name]] = int(values[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+def reset_peak_memory():
+    """Zera o pico de RSS do processo (VmHWM) no valor atual; retorna False se não for possível"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+# Reciclagem de workers por memória (ver post_request em gunicorn_config.py): em MB de memória
+# anônima, que exclui os pesos mapeados do arquivo compartilhado; 0 desativa. Sem valor definido,
+# o gunicorn_config.py o calcula a partir do limite de memória do contêiner e do número de workers
+WORKER_MAX_MEMORY_MB = int(os.getenv('WORKER_MAX_MEMORY_MB') or '0')
+
+def memory_limit_exceeded():
+    """Indica se a memória anônima do processo passou de WORKER_MAX_MEMORY_MB"""
+    if WORKER_MAX_MEMORY_MB <= 0:
+        return False
+    return process_memory().get('anon', 0) > WORKER_MAX_MEMORY_MB * 1024 * 1024
+
+# Tempos de inicialização do processo (importações), expostos em /ready
+startup_timings = {}
+
+# Configuração inicial da remoção de fundo
+rembg_version = package_version("rembg")
+
+def rembg_session_classes():
+    """Classes de sessão do rembg; só a primeira chamada, na importação do app, importa o pacote.
+    
+    O pacote rembg importa pymatting, numba, scipy e OpenCV. Importado pela primeira vez fora
+    da thread principal (em uma thread de inferência ou de aquecimento), ele impede que o
+    processo termine: por isso é importado junto com o app, na thread que o importa. Com o
+    Gunicorn (preload_app), o master importa o app e os workers herdam os módulos pelo fork.
+    """
+    start = time.perf_counter()
+    from rembg.sessions import sessions_class
+    # Só a primeira chamada importa de fato; as demais encontram o módulo em sys.modules
+    startup_timings.setdefault('rembg_import_ms', round((time.perf_counter() - start) * 1000, 1))
+    return sessions_class
+
+rembg_session_classes()
+
+# Modelo e número de threads do ONNX Runtime (0 = padrão do ONNX Runtime)
+REMBG_MODEL = os.getenv('REMBG_MODEL', 'u2net')
+ORT_INTRA_OP_THREADS = int(os.getenv('ORT_INTRA_OP_THREADS', '0'))
+ORT_INTER_OP_THREADS = int(os.getenv('ORT_INTER_OP_THREADS', '0'))
+
+# Pesos do modelo compartilhados entre processos: o modelo é otimizado uma única vez e seus pesos
+# ficam em um arquivo mapeado em memória (MODEL_SHARED_DIR, padrão: <U2NET_HOME>/shared), de modo
+# que todos os workers usam as mesmas páginas do cache do sistema em vez de uma cópia cada
+MODEL_SHARED_WEIGHTS = os.getenv('MODEL_SHARED_WEIGHTS', '1') == '1'
+MODEL_SHARED_DIR = os.getenv('MODEL_SHARED_DIR', '')
+SHARED_WEIGHT_MIN_BYTES = 4096  # tensores pequenos (formas, escalas) continuam dentro do modelo
+SHARED_WEIGHT_ALIGNMENT = 64
+
+# Tipos de tensor do ONNX (TensorProto.DataType) que podem ser mapeados diretamente com numpy
+ONNX_DTYPES = {
+    1: np.float32, 2: np.uint8, 3: np.int8, 4: np.uint16, 5: np.int16,
+    6: np.int32, 7: np.int64, 10: np.float16, 11: np.float64,
+}
+
+def _read_varint(buf, pos):
+    """Lê um inteiro varint do protobuf a partir de pos e retorna (valor, nova posição)"""
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+def _protobuf_fields(buf, start, end):
+    """Percorre os campos de uma mensagem protobuf entre start e end.
+
+    Gera (número do campo, tipo, valor); campos de tamanho variável têm como valor
+    o intervalo (início, fim) no buffer, sem copiar os dados.
+    """
+    pos = start
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value, pos = None, pos + 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value, pos = (pos, pos + length), pos + length
+        elif wire_type == 5:
+            value, pos = None, pos + 4
+        else:
+            raise ValueError(f"Tipo de campo protobuf não suportado: {wire_type}")
+        yield field, wire_type, value
+
+def onnx_initializers(buf):
+    """Localiza os pesos (initializers com raw_data) de um modelo ONNX serializado.
+
+    Retorna uma lista de (nome, tipo numpy, forma, início, fim), com a posição dos
+    dados no buffer. Lê apenas a estrutura do arquivo, sem depender do pacote onnx.
+    """
+    initializers = []
+    for field, wire_type, graph in _protobuf_fields(buf, 0, len(buf)):
+        if field != 7 or wire_type != 2:  # ModelProto.graph
+            continue
+        for graph_field, graph_wire_type, tensor in _protobuf_fields(buf, *graph):
+            if graph_field != 5 or graph_wire_type != 2:  # GraphProto.initializer
                 continue
-                
-            # Verificar idade do arquivo
-            file_age_hours = (now - os.path.getmtime(filepath)) / 3600
-            
-            if file_age_hours > max_age_hours:
-                os.remove(filepath)
-                count += 1
-                
-        if count > 0:
-            logger.info(f"Limpeza de arquivos: {count} arquivos removidos de {directory}")
-    except Exception as e:
-        logger.error(f"Erro na limpeza de arquivos: {str(e)}")
+            name, data_type, dims, raw_data, external = None, None, [], None, False
+            for tensor_field, tensor_wire_type, value in _protobuf_fields(buf, *tensor):
+                if tensor_field == 1 and tensor_wire_type == 0:
+                    dims.append(value)
+                elif tensor_field == 1:
+                    pos, end = value
+                    while pos < end:
+                        dim, pos = _read_varint(buf, pos)
+                        dims.append(dim)
+                elif tensor_field == 2:
+                    data_type = value
+                elif tensor_field == 8:
+                    name = bytes(buf[value[0]:value[1]]).decode('utf-8')
+                elif tensor_field == 9:
+                    raw_data = value
+                elif tensor_field == 14:
+                    external = value == 1
+            if name and raw_data and not external and data_type in ONNX_DTYPES:
+                initializers.append((name, ONNX_DTYPES[data_type], tuple(dims), raw_data[0], raw_data[1]))
+    return initializers
+
+class SharedModelWeights:
+    """Versão otimizada de um modelo ONNX com os pesos em um arquivo mapeado em memória.
+
+    O primeiro processo aplica as otimizações de grafo do ONNX Runtime (que, feitas em cada
+    sessão, criariam cópias privadas dos pesos), grava o modelo otimizado e extrai seus pesos,
+    alinhados, para um arquivo .weights. As sessões seguintes carregam o modelo otimizado sem
+    novas otimizações e recebem os pesos como visões do arquivo mapeado (add_initializer).
+    """
+
+    def __init__(self, model_path, shared_dir):
+        import onnxruntime as ort
+        import platform
+
+        # Modelos otimizados dependem da CPU e da versão do ONNX Runtime
+        stat = os.stat(model_path)
+        fingerprint = f"{os.path.abspath(model_path)}:{stat.st_size}:{stat.st_mtime_ns}:{ort.__version__}:{platform.machine()}"
+        base_name = f"{os.path.splitext(os.path.basename(model_path))[0]}-{hashlib.sha1(fingerprint.encode()).hexdigest()[:12]}"
+        self.model_path = model_path
+        self.shared_dir = shared_dir
+        self.optimized_path = os.path.join(shared_dir, base_name + '.onnx')
+        self.weights_path = os.path.join(shared_dir, base_name + '.weights')
+        self.index_path = os.path.join(shared_dir, base_name + '.json')
+
+    def prepare(self):
+        """Gera o modelo otimizado e o arquivo de pesos, se ainda não existirem"""
+        import fcntl
+
+        if os.path.exists(self.index_path):
+            return
+        os.makedirs(self.shared_dir, exist_ok=True)
+        # Um único processo prepara os arquivos; os demais esperam pelo lock e reaproveitam
+        with open(os.path.join(self.shared_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(self.index_path):
+                self._optimize()
+                self._extract_weights()
+
+    def _optimize(self):
+        import onnxruntime as ort
+
+        sess_opts = ort.SessionOptions()
+        sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_opts.optimized_model_filepath = self.optimized_path + '.tmp'
+        sess_opts.log_severity_level = 3  # o aviso sobre otimizações específicas da CPU é esperado
+        ort.InferenceSession(self.model_path, sess_options=sess_opts, providers=['CPUExecutionProvider'])
+        os.replace(self.optimized_path + '.tmp', self.optimized_path)
+
+    def _extract_weights(self):
+        import mmap
+
+        index = []
+        with open(self.optimized_path, 'rb') as model_file, \
+                mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ) as buf, \
+                open(self.weights_path + '.tmp', 'wb') as weights_file:
+            offset = 0
+            for name, dtype, shape, start, end in onnx_initializers(buf):
+                if end - start < SHARED_WEIGHT_MIN_BYTES:
+                    continue
+                padding = -offset % SHARED_WEIGHT_ALIGNMENT
+                weights_file.write(b'\0' * padding)
+                offset += padding
+                weights_file.write(buf[start:end])
+                index.append({'name': name, 'dtype': np.dtype(dtype).str, 'shape': shape, 'offset': offset})
+                offset += end - start
+        os.replace(self.weights_path + '.tmp', self.weights_path)
+        with open(self.index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def apply(self, sess_opts):
+        """Registra os pesos mapeados nas opções da sessão.
+
+        Retorna os OrtValues criados, que precisam existir enquanto a sessão existir.
+        """
+        import onnxruntime as ort
+
+        with open(self.index_path) as f:
+            index = json.load(f)
+        values = []
+        # Modelos sem pesos grandes geram um arquivo vazio, que não pode ser mapeado
+        weights = np.memmap(self.weights_path, dtype=np.uint8, mode='r') if index else None
+        for entry in index:
+            dtype = np.dtype(entry['dtype'])
+            size = int(np.prod(entry['shape'], dtype=np.int64)) * dtype.itemsize
+            array = weights[entry['offset']:entry['offset'] + size].view(dtype).reshape(entry['shape'])
+            value = ort.OrtValue.ortvalue_from_numpy(array)
+            sess_opts.add_initializer(entry['name'], value)
+            values.append(value)
+        # O modelo gravado já está otimizado; otimizar de novo criaria cópias dos pesos
+        sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return values
+
+class RembgSessionManager:
+    """Mantém uma única sessão do rembg por processo, reutilizada entre requisições"""
+
+    def __init__(self, model_name, intra_op_threads=0, inter_op_threads=0, shared_weights=False):
+        self.model_name = model_name
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.shared_weights = shared_weights
+        self.load_time = None
+        self.warmup_time = None
+        self.loaded_at = None
+        self.error = None
+        self._session = None
+        self._shared_values = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Retorna a sessão do processo atual, criando-a na primeira chamada"""
+        # Sessões do ONNX Runtime não devem ser herdadas pelo fork: recriar em cada worker
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._load()
+        return self._session
+
+    def _load(self):
+        """Cria a sessão do modelo com as opções de threads configuradas"""
+        session_class = next((sc for sc in rembg_session_classes() if sc.name() == self.model_name), None)
+        if session_class is None:
+            self.error = f"Modelo desconhecido: {self.model_name}"
+            raise ValueError(self.error)
+
+        start_time = time.time()
+        try:
+            session = self._load_shared(session_class) if self.shared_weights else None
+            session = session or session_class(self.model_name, self._session_options())
+            load_time = time.time() - start_time
+            # A sessão só é publicada depois do aquecimento: a primeira requisição não paga a inicialização
+            self.warmup_time = self._warm_up(session)
+        except Exception as e:
+            self.error = str(e)
+            logging.getLogger(__name__).error(f"Erro ao inicializar rembg ({self.model_name}): {self.error}")
+            raise
+        self._session = session
+        self._pid = os.getpid()
+        self.load_time = load_time
+        self.loaded_at = datetime.utcnow().isoformat()
+        self.error = None
+        logging.getLogger(__name__).info(
+            f"Sessão rembg carregada: modelo {self.model_name} em {self.load_time:.2f}s, aquecida em "
+            f"{self.warmup_time:.2f}s (pid {self._pid}, pesos compartilhados: {'sim' if self._shared_values is not None else 'não'})"
+        )
+
+    def _warm_up(self, session):
+        """Executa o modelo uma vez com um tensor de zeros; retorna a duração em segundos.
+        
+        A primeira execução do ONNX Runtime aloca os buffers e prepara os kernels.
+        """
+        start_time = time.time()
+        spec = MODEL_SPECS.get(self.model_name)
+        (width, height) = spec[0] if spec else (320, 320)
+        model_input = session.inner_session.get_inputs()[0]
+        # Dimensões dinâmicas (lote, altura e largura) recebem o tamanho de entrada do modelo
+        defaults = [1, 3, height, width]
+        shape = [dim if isinstance(dim, int) and dim > 0 else defaults[index] for index, dim in enumerate(model_input.shape)]
+        session.inner_session.run(None, {model_input.name: np.zeros(shape, dtype=np.float32)})
+        return time.time() - start_time
+
+    def _session_options(self):
+        import onnxruntime as ort
+
+        sess_opts = ort.SessionOptions()
+        if self.intra_op_threads > 0:
+            sess_opts.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads > 0:
+            sess_opts.inter_op_num_threads = self.inter_op_threads
+        return sess_opts
+
+    def _load_shared(self, session_class):
+        """Cria a sessão a partir do modelo otimizado, com os pesos mapeados em memória.
+
+        Retorna None quando os pesos não podem ser compartilhados; nesse caso a sessão
+        é criada normalmente pelo rembg.
+        """
+        import onnxruntime as ort
+
+        self._shared_values = None
+        if ort.get_device() != 'CPU':
+            return None  # o modelo otimizado gravado é específico para CPU
+        try:
+            model_path = session_class.download_models()
+            shared = SharedModelWeights(model_path, MODEL_SHARED_DIR or os.path.join(session_class.u2net_home(), 'shared'))
+            shared.prepare()
+            sess_opts = self._session_options()
+            values = shared.apply(sess_opts)
+            session = session_class.__new__(session_class)
+            session.model_name = self.model_name
+            session.inner_session = ort.InferenceSession(
+                shared.optimized_path, sess_options=sess_opts, providers=['CPUExecutionProvider']
+            )
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                f"Pesos compartilhados indisponíveis para {self.model_name}, carregando o modelo normalmente: {e}"
+            )
+            return None
+        self._shared_values = values
+        return session
+
+    def status(self):
+        """Resumo do estado da sessão para o endpoint de saúde"""
+        loaded = self._session is not None and self._pid == os.getpid()
+        info = {
+            "model": self.model_name,
+            "rembg_version": rembg_version,
+            "loaded": loaded,
+            "intra_op_threads": self.intra_op_threads,
+            "inter_op_threads": self.inter_op_threads,
+        }
+        if loaded:
+            info["model_file"] = os.path.basename(getattr(self._session.inner_session, '_model_path', None) or '')
+            info["providers"] = self._session.inner_session.get_providers()
+            info["shared_weights"] = self._shared_values is not None
+            info["load_time_ms"] = round(self.load_time * 1000, 1)
+            info["warmup_ms"] = round(self.warmup_time * 1000, 1)
+            info["loaded_at"] = self.loaded_at
+            info["pid"] = self._pid
+        if self.error:
+            info["error"] = self.error
+        return info
+
+class RembgSessionPool:
+    """Sessões de vários modelos por processo, carregadas sob demanda.
+
+    Mantém até max_sessions modelos carregados; ao carregar um novo modelo além do limite,
+    descarta o usado há mais tempo (LRU). Sem argumentos, get() retorna o modelo padrão.
+    """
+
+    def __init__(self, default_model, max_sessions, **session_options):
+        self.model_name = default_model
+        self.max_sessions = max(1, max_sessions)
+        self.session_options = session_options
+        self._managers = OrderedDict()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self, model_name=None):
+        """Retorna a sessão do modelo pedido (ou do padrão), carregando-a se necessário"""
+        model_name = model_name or self.model_name
+        with self._lock:
+            if self._pid != os.getpid():
+                self._managers = OrderedDict()
+                self._pid = os.getpid()
+            manager = self._managers.get(model_name)
+            if manager is None:
+                manager = RembgSessionManager(model_name, **self.session_options)
+                self._managers[model_name] = manager
+                while len(self._managers) > self.max_sessions:
+                    evicted, _ = self._managers.popitem(last=False)
+                    logging.getLogger(__name__).info(f"Sessão rembg descartada do pool: modelo {evicted} (pid {self._pid})")
+            else:
+                self._managers.move_to_end(model_name)
         
+        # O carregamento acontece fora do lock do pool: outros modelos continuam disponíveis
+        try:
+            return manager.get()
+        except Exception:
+            with self._lock:
+                if self._managers.get(model_name) is manager:
+                    del self._managers[model_name]
+            raise
+
+    def status(self):
+        """Estado do modelo padrão e lista dos modelos carregados neste processo"""
+        with self._lock:
+            managers = dict(self._managers) if self._pid == os.getpid() else {}
+        default = managers.get(self.model_name) or RembgSessionManager(self.model_name, **self.session_options)
+        info = default.status()
+        info["loaded_models"] = list(managers)
+        info["max_sessions"] = self.max_sessions
+        return info
+
+class ModelUnavailable(Exception):
+    """O arquivo do modelo pedido ainda está sendo baixado"""
+
+# Downloads de modelos em andamento neste processo
+_model_downloads = set()
+_model_downloads_lock = threading.Lock()
+
+def model_downloaded(model_name):
+    """Indica se o arquivo .onnx do modelo já está em U2NET_HOME"""
+    session_class = next((sc for sc in rembg_session_classes() if sc.name() == model_name), None)
+    return session_class is not None and os.path.exists(os.path.join(session_class.u2net_home(), f"{model_name}.onnx"))
+
+def _download_model(model_name):
+    """Baixa o arquivo do modelo; entre processos, um único download por vez (lock em U2NET_HOME)"""
+    import fcntl
+
+    try:
+        session_class = next(sc for sc in rembg_session_classes() if sc.name() == model_name)
+        os.makedirs(session_class.u2net_home(), exist_ok=True)
+        with open(os.path.join(session_class.u2net_home(), f".{model_name}.download.lock"), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not model_downloaded(model_name):
+                logging.getLogger(__name__).info(f"Baixando o modelo {model_name}")
+                session_class.download_models()
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Erro ao baixar o modelo {model_name}: {str(e)}")
+    finally:
+        with _model_downloads_lock:
+            _model_downloads.discard(model_name)
+
+def require_model(model_name):
+    """Levanta ModelUnavailable se o modelo ainda não foi baixado, iniciando o download em segundo plano.
+    
+    O download de um modelo (até ~1GB) nunca acontece na thread da requisição: a requisição é
+    recusada com 503 e Retry-After, e as seguintes são aceitas quando o arquivo estiver completo.
+    """
+    if model_downloaded(model_name):
+        return
+    with _model_downloads_lock:
+        if model_name not in _model_downloads:
+            _model_downloads.add(model_name)
+            threading.Thread(target=_download_model, args=(model_name,), name='model-download', daemon=True).start()
+    raise ModelUnavailable(model_name)
+
+# Número máximo de modelos carregados ao mesmo tempo em cada processo
+SESSION_POOL_SIZE = int(os.getenv('SESSION_POOL_SIZE', '2'))
+
+rembg_sessions = RembgSessionPool(
+    REMBG_MODEL, SESSION_POOL_SIZE,
+    intra_op_threads=ORT_INTRA_OP_THREADS, inter_op_threads=ORT_INTER_OP_THREADS, shared_weights=MODEL_SHARED_WEIGHTS,
+)
+
 # Agendador para limpar arquivos periodicamente
 def schedule_cleanup(app):
-    """Configura limpeza periódica de arquivos temporários"""
-    import threading
+    """Configura limpeza periódica de arquivos temporários.
+    
+    Chamada uma vez por servidor, no processo auxiliar (ver start_background_services).
+    """
+    def schedule():
+        # Daemon: o timer pendente não impede o encerramento do processo
+        timer = threading.Timer(3600, cleanup_task)
+        timer.daemon = True
+        timer.start()
     
     def cleanup_task():
-        with app.app_context():
-            # Limpar arquivos com mais de 24 horas
-            cleanup_old_files(UPLOAD_FOLDER, 24)
-            cleanup_old_files(PROCESSED_FOLDER, 24)
-            
+        try:
+            with app.app_context():
+                # Remover resultados vencidos e jobs (com seus arquivos de entrada) com mais de 24 horas
+                result_storage.delete_expired()
+                delete_legacy_files(UPLOAD_FOLDER, '_input', STORAGE_TTL_HOURS)
+                cleanup_old_jobs(24)
+                if isinstance(limiter.storage, SQLiteRateLimitStorage):
+                    limiter.storage.delete_expired()
+        except Exception as e:
+            logger.error(f"Erro na limpeza periódica: {str(e)}")
+        finally:
             # Agendar próxima execução (a cada 1 hora)
-            threading.Timer(3600, cleanup_task).start()
+            schedule()
     
     # Iniciar a tarefa de limpeza
-    threading.Timer(3600, cleanup_task).start()
+    schedule()
     logger.info("Agendador de limpeza iniciado")
 
+# Parâmetros de entrada dos modelos suportados pela inferência em lote
+# (tamanho de entrada, média e desvio padrão da normalização, e se a saída precisa de sigmoide)
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+MODEL_SPECS = {
+    'u2net': ((320, 320), IMAGENET_MEAN, IMAGENET_STD, False),
+    'u2netp': ((320, 320), IMAGENET_MEAN, IMAGENET_STD, False),
+    'u2net_human_seg': ((320, 320), IMAGENET_MEAN, IMAGENET_STD, False),
+    'silueta': ((320, 320), IMAGENET_MEAN, IMAGENET_STD, False),
+    'isnet-general-use': ((1024, 1024), (0.5, 0.5, 0.5), (1.0, 1.0, 1.0), False),
+    'isnet-anime': ((1024, 1024), (0.5, 0.5, 0.5), (1.0, 1.0, 1.0), False),
+    'birefnet-general': ((1024, 1024), IMAGENET_MEAN, IMAGENET_STD, True),
+    'birefnet-general-lite': ((1024, 1024), IMAGENET_MEAN, IMAGENET_STD, True),
+    'birefnet-portrait': ((1024, 1024), IMAGENET_MEAN, IMAGENET_STD, True),
+}
+
+# Modelos que podem ser escolhidos por requisição (model=) e níveis de qualidade (quality=).
+# Por padrão, só o modelo padrão e os dos níveis: cada modelo carregado ocupa memória em todos os workers
+QUALITY_TIERS = dict(
+    tier.strip().split(':', 1)
+    for tier in os.getenv('QUALITY_TIERS', f'fast:u2netp,balanced:{REMBG_MODEL},best:isnet-general-use').split(',')
+    if tier.strip()
+)
+ALLOWED_MODELS = [
+    name.strip()
+    for name in (os.getenv('ALLOWED_MODELS') or ','.join(OrderedDict.fromkeys([REMBG_MODEL, *QUALITY_TIERS.values()]))).split(',')
+    if name.strip()
+]
+if REMBG_MODEL not in ALLOWED_MODELS:
+    ALLOWED_MODELS.append(REMBG_MODEL)
+_tier_models_not_allowed = sorted(set(QUALITY_TIERS.values()) - set(ALLOWED_MODELS))
+if _tier_models_not_allowed:
+    raise ValueError(f"Modelos de QUALITY_TIERS fora de ALLOWED_MODELS: {', '.join(_tier_models_not_allowed)}")
+
+# Inferência em lote: tamanho máximo do lote e janela de espera para agrupar requisições concorrentes
+INFERENCE_BATCH_SIZE = int(os.getenv('INFERENCE_BATCH_SIZE', '4'))
+INFERENCE_BATCH_WAIT_MS = float(os.getenv('INFERENCE_BATCH_WAIT_MS', '0'))  # 0 = sem agrupamento
+
+def predict_masks(images, session):
+    """Calcula as máscaras de várias imagens com uma única execução do modelo.
+    
+    As imagens são redimensionadas para o tamanho de entrada do modelo e empilhadas
+    em um único tensor NCHW. As máscaras são devolvidas na resolução do modelo;
+    cabe a _apply_mask ampliá-las para o tamanho de cada imagem.
+    """
+    spec = MODEL_SPECS.get(session.model_name)
+    if spec is None:
+        # Modelos sem especificação conhecida usam a predição do próprio rembg, uma imagem por vez
+        return [session.predict(image)[0] for image in images]
+    
+    (width, height), mean, std, sigmoid = spec
+    mean = np.array(mean, dtype=np.float32).reshape(3, 1, 1)
+    std = np.array(std, dtype=np.float32).reshape(3, 1, 1)
+    
+    with timed_stage('resize'):
+        batch = input_tensor(len(images), height, width)
+        for i, image in enumerate(images):
+            # reducing_gap reduz imagens grandes por blocos antes do filtro, em uma única passada
+            resized = image.convert('RGB') if image.mode != 'RGB' else image
+            pixels = np.asarray(resized.resize((width, height), Image.LANCZOS, reducing_gap=3.0))
+            # Normalização feita no próprio tensor, sem cópias intermediárias em float
+            target = batch[i]
+            target[...] = pixels.transpose((2, 0, 1))
+            target /= max(float(pixels.max()), 1e-6)
+            target -= mean
+            target /= std
+    
+    with timed_stage('inference'):
+        inner_session = session.inner_session
+        model_input = inner_session.get_inputs()[0]
+        # Modelos exportados com lote fixo são executados em fatias do tamanho aceito
+        chunk_size = model_input.shape[0] if isinstance(model_input.shape[0], int) else len(images)
+        predictions = []
+        for offset in range(0, len(images), max(chunk_size, 1)):
+            outputs = inner_session.run(None, {model_input.name: batch[offset:offset + chunk_size]})
+            predictions.extend(outputs[0][:, 0, :, :])
+        
+        masks = []
+        for pred in predictions:
+            # Sigmoide e normalização no próprio array de saída do modelo
+            if sigmoid:
+                np.negative(pred, out=pred)
+                np.exp(pred, out=pred)
+                pred += 1
+                np.reciprocal(pred, out=pred)
+            mi, ma = float(pred.min()), float(pred.max())
+            if ma > mi:
+                pred -= mi
+                pred *= 255 / (ma - mi)
+                np.clip(pred, 0, 255, out=pred)
+            else:
+                pred[...] = 0
+            masks.append(Image.fromarray(pred.astype(np.uint8), mode='L'))
+    return masks
+
+# Inferência por blocos para imagens grandes: máscara global em baixa resolução refinada
+# por blocos sobrepostos apenas na região do contorno
+TILED_INFERENCE_THRESHOLD = int(os.getenv('TILED_INFERENCE_THRESHOLD', '2500'))  # Maior lado a partir do qual refinar
+TILE_SIZE = int(os.getenv('TILE_SIZE', '1024'))
+TILE_OVERLAP = int(os.getenv('TILE_OVERLAP', '128'))
+TILE_BAND_WIDTH = 0.01  # Largura da faixa de contorno, como fração do maior lado
+
+def uses_tiled_inference(width, height):
+    """Indica se a máscara de uma imagem deve ser refinada em blocos.
+    
+    Imagens finas, com o menor lado abaixo de TILE_SIZE, vão inteiras ao modelo: blocos
+    menores que o lado curto multiplicariam as execuções do modelo ao longo do lado longo.
+    """
+    return max(width, height) > TILED_INFERENCE_THRESHOLD and min(width, height) >= TILE_SIZE
+
+def _tile_overlap(size):
+    """Sobreposição entre blocos de size pixels: TILE_OVERLAP, limitado a um quarto do bloco"""
+    return min(TILE_OVERLAP, size // 4)
+
+def _tile_boxes(width, height):
+    """Caixas (x0, y0, x1, y1) de blocos de TILE_SIZE que cobrem a imagem com sobreposição"""
+    size = min(TILE_SIZE, width, height)
+    stride = max(size - _tile_overlap(size), 1)
+    xs = list(range(0, max(width - size, 0) + 1, stride))
+    ys = list(range(0, max(height - size, 0) + 1, stride))
+    # O último bloco de cada eixo é alinhado à borda da imagem
+    if xs[-1] + size < width:
+        xs.append(width - size)
+    if ys[-1] + size < height:
+        ys.append(height - size)
+    return [(x, y, x + size, y + size) for y in ys for x in xs]
+
+def _tile_weights(box, width, height, overlap):
+    """Pesos de mistura de um bloco: rampa linear nas bordas internas, 1 nas bordas da imagem"""
+    x0, y0, x1, y1 = box
+    def ramp(length, start_inside, end_inside):
+        weights = np.ones(length, dtype=np.float32)
+        steps = min(overlap, length // 2)
+        if steps:
+            edge = np.arange(1, steps + 1, dtype=np.float32) / (steps + 1)
+            if start_inside:
+                weights[:steps] = edge
+            if end_inside:
+                weights[-steps:] = edge[::-1]
+        return weights
+    return np.outer(ramp(y1 - y0, y0 > 0, y1 < height), ramp(x1 - x0, x0 > 0, x1 < width))
+
+def boundary_band(mask):
+    """Faixa suavizada (modo L) em torno do contorno e das regiões incertas de uma máscara"""
+    radius = max(1, int(max(mask.size) * TILE_BAND_WIDTH / 2))
+    solid = mask.point(lambda v: 255 if v > 127 else 0)
+    edges = np.asarray(solid.filter(ImageFilter.MaxFilter(3)), dtype=np.int16)
+    edges -= np.asarray(solid.filter(ImageFilter.MinFilter(3)), dtype=np.int16)
+    values = np.asarray(mask)
+    band = (edges > 0) | ((values > 16) & (values < 239))
+    # Dilatação por média em caixa (custo constante por pixel) seguida de suavização das bordas
+    band = Image.fromarray(band.astype(np.uint8) * 255, mode='L').filter(ImageFilter.BoxBlur(radius))
+    return band.point(lambda v: 255 if v else 0).filter(ImageFilter.GaussianBlur(radius / 2))
+
+def predict_mask_tiled(image, session):
+    """Calcula a máscara de uma imagem grande por refinamento em blocos.
+    
+    Uma máscara global é calculada com a imagem inteira reduzida para TILE_SIZE pixels
+    no maior lado. Só os blocos que cruzam o contorno dessa máscara passam pelo modelo
+    em alta resolução, em lotes de até INFERENCE_BATCH_SIZE; cada bloco é misturado à
+    máscara dentro da faixa do contorno, com rampas nas sobreposições para esconder as
+    emendas. A memória de trabalho depende do tamanho do bloco, não da imagem, e o custo
+    cresce com o comprimento do contorno.
+    """
+    width, height = image.size
+    scale = min(TILE_SIZE / max(width, height), 1.0)
+    coarse_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    
+    with timed_stage('resize'):
+        coarse_image = image.resize(coarse_size, Image.BILINEAR, reducing_gap=2.0)
+    coarse_mask = predict_masks([coarse_image], session)[0]
+    del coarse_image
+    
+    with timed_stage('composite'):
+        coarse_mask = coarse_mask.resize(coarse_size, Image.BILINEAR)
+        band = boundary_band(coarse_mask)
+        mask = coarse_mask.resize(image.size, Image.BILINEAR)
+    
+    boxes = _tile_boxes(width, height)
+    edge_tiles = []
+    for box in boxes:
+        # Caixa correspondente na máscara global, com a escala de cada eixo após o arredondamento
+        x0, y0, x1, y1 = box
+        coarse_box = (
+            x0 * coarse_size[0] / width, y0 * coarse_size[1] / height,
+            min(x1 * coarse_size[0] / width, coarse_size[0]), min(y1 * coarse_size[1] / height, coarse_size[1]),
+        )
+        crop = band.crop(tuple(int(v) for v in coarse_box[:2]) + tuple(int(np.ceil(v)) for v in coarse_box[2:]))
+        if crop.getbbox():
+            edge_tiles.append((box, coarse_box))
+    logger.debug(f"Refinamento em blocos: {len(edge_tiles)} de {len(boxes)} blocos no contorno")
+    
+    for offset in range(0, len(edge_tiles), max(INFERENCE_BATCH_SIZE, 1)):
+        chunk = edge_tiles[offset:offset + INFERENCE_BATCH_SIZE]
+        tiles = [image.crop(box) for box, _ in chunk]
+        predictions = predict_masks(tiles, session)
+        del tiles
+        
+        with timed_stage('composite'):
+            for (box, coarse_box), prediction in zip(chunk, predictions):
+                tile_size = (box[2] - box[0], box[3] - box[1])
+                refined = np.asarray(prediction.resize(tile_size, Image.BILINEAR), dtype=np.float32)
+                weights = _tile_weights(box, width, height, _tile_overlap(tile_size[0]))
+                weights *= np.asarray(band.resize(tile_size, Image.BILINEAR, box=coarse_box), dtype=np.float32) / 255
+                current = np.asarray(mask.crop(box), dtype=np.float32)
+                current += (refined - current) * weights
+                mask.paste(Image.fromarray(current.round().astype(np.uint8), mode='L'), box)
+    return mask
+
+def predict_mask(image, session):
+    """Máscara de uma imagem: direta (com agrupamento) ou, para imagens grandes, em blocos"""
+    if uses_tiled_inference(*image.size):
+        return predict_mask_tiled(image, session)
+    return inference_batcher.predict(image, session)
+
+# Tensores de entrada do modelo, por thread e por tamanho de entrada, reaproveitados entre chamadas
+_input_tensors = threading.local()
+
+def input_tensor(count, height, width):
+    """Tensor NCHW em float32 para count imagens, fatiado de um buffer reaproveitado.
+    
+    O buffer comporta ao menos INFERENCE_BATCH_SIZE imagens e só é realocado se um lote
+    maior for pedido; cada thread de inferência tem o seu.
+    """
+    buffers = getattr(_input_tensors, 'buffers', None)
+    if buffers is None:
+        buffers = _input_tensors.buffers = {}
+    buffer = buffers.get((height, width))
+    if buffer is None or buffer.shape[0] < count:
+        buffer = np.empty((max(count, INFERENCE_BATCH_SIZE, 1), 3, height, width), dtype=np.float32)
+        buffers[(height, width)] = buffer
+    return buffer[:count]
+
+class InferenceBatcher:
+    """Agrupa inferências concorrentes do mesmo worker em um único lote.
+    
+    Cada chamada a predict() espera até max_wait segundos por outras requisições
+    antes de executar o modelo com até max_batch_size imagens.
+    """
+
+    def __init__(self, max_batch_size, max_wait):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_wait > 0 and self.max_batch_size > 1
+
+    def predict(self, image, session):
+        """Retorna a máscara de uma imagem, possivelmente calculada junto com outras"""
+        if not self.enabled:
+            return predict_masks([image], session)[0]
+        
+        self._ensure_thread()
+        pending = {'image': image, 'session': session, 'done': threading.Event(), 'queued_at': time.perf_counter()}
+        # A inferência em si é registrada no histograma pela thread do agrupador
+        with timed_stage('inference', observe=False):
+            self._queue.put(pending)
+            pending['done'].wait()
+        if 'error' in pending:
+            raise pending['error']
+        return pending['mask']
+
+    def _ensure_thread(self):
+        # A thread não sobrevive ao fork: iniciar uma por processo
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._thread = threading.Thread(target=self._run, name='inference-batcher', daemon=True)
+                    self._thread.start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            started_at = time.perf_counter()
+            for pending in batch:
+                QUEUE_WAIT_SECONDS.labels(queue='inference').observe(started_at - pending['queued_at'])
+            
+            # Requisições de modelos diferentes são executadas separadamente
+            groups = OrderedDict()
+            for pending in batch:
+                groups.setdefault(id(pending['session']), []).append(pending)
+            for group in groups.values():
+                try:
+                    masks = predict_masks([pending['image'] for pending in group], group[0]['session'])
+                    for pending, mask in zip(group, masks):
+                        pending['mask'] = mask
+                except Exception as e:
+                    for pending in group:
+                        pending['error'] = e
+                finally:
+                    for pending in group:
+                        pending['done'].set()
+
+# Executor de CPU: separa o processamento das threads de I/O do Gunicorn (gthread)
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '1'))  # Tarefas de CPU simultâneas por worker
+# Tarefas aguardando antes de recusar com 503; o gunicorn_config.py a limita às threads do worker
+INFERENCE_QUEUE_SIZE = int(os.getenv('INFERENCE_QUEUE_SIZE') or '8')
+
+# O agrupador fica atrás do executor: só há requisições simultâneas para agrupar com mais de
+# um INFERENCE_WORKERS, e um lote nunca passa desse número
+inference_batcher = InferenceBatcher(min(INFERENCE_BATCH_SIZE, INFERENCE_WORKERS), INFERENCE_BATCH_WAIT_MS / 1000)
+if INFERENCE_BATCH_WAIT_MS > 0 and not inference_batcher.enabled:
+    logging.getLogger(__name__).warning(
+        "INFERENCE_BATCH_WAIT_MS ignorado: o agrupamento requer INFERENCE_WORKERS e INFERENCE_BATCH_SIZE maiores que 1"
+    )
+INFERENCE_RETRY_AFTER = int(os.getenv('INFERENCE_RETRY_AFTER', '5'))  # Segundos sugeridos no Retry-After
+
+class InferenceQueueFull(Exception):
+    """A fila do executor de inferência está cheia"""
+
+class InferenceExecutor:
+    """Executa o trabalho de CPU em um pool limitado de threads, com fila limitada.
+    
+    Quando há max_workers tarefas em execução e max_queue aguardando, novas tarefas
+    são recusadas com InferenceQueueFull em vez de se acumularem no worker.
+    """
+
+    def __init__(self, max_workers, max_queue):
+        self.max_workers = max(max_workers, 1)
+        self.max_queue = max(max_queue, 0)
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+        self._in_flight = 0
+        self._tasks = queue.Queue()
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def is_full(self):
+        """Indica se uma nova tarefa seria recusada neste momento"""
+        return self._in_flight >= self.max_workers + self.max_queue
+
+    def run(self, fn, *args, **kwargs):
+        """Executa fn no pool e espera o resultado; levanta InferenceQueueFull se não houver vaga"""
+        task = self._submit(fn, args, kwargs)
+        try:
+            task['done'].wait()
+            if task.get('peak_memory') is not None:
+                _stage_timings.peak_memory = max(getattr(_stage_timings, 'peak_memory', None) or 0, task['peak_memory'])
+            if 'error' in task:
+                raise task['error']
+            return task['result']
+        finally:
+            self._release()
+
+    def stream(self, fn, *args, **kwargs):
+        """Executa o gerador fn no pool e repassa seus itens à medida que ficam prontos.
+        
+        A vaga é verificada na chamada, para que InferenceQueueFull seja levantada antes do
+        início da resposta, mas só é ocupada quando o consumidor começa a ler. Os itens passam
+        um a um: fn só produz o próximo depois que o anterior foi lido, e para de produzir
+        quando o consumidor é encerrado (cliente desconectado).
+        """
+        if self.is_full():
+            raise InferenceQueueFull()
+        return self._stream(fn, args, kwargs)
+
+    def _stream(self, fn, args, kwargs):
+        items = queue.Queue(maxsize=1)
+        cancelled = threading.Event()
+        end = object()
+        
+        def put(item):
+            while not cancelled.is_set():
+                try:
+                    items.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        
+        def produce():
+            try:
+                for item in fn(*args, **kwargs):
+                    if not put(item):
+                        break
+            finally:
+                put(end)
+        
+        task = self._submit(produce, (), {})
+        try:
+            while True:
+                item = items.get()
+                if item is end:
+                    break
+                yield item
+            task['done'].wait()
+            if 'error' in task:
+                raise task['error']
+        finally:
+            # A vaga só é liberada quando a thread do pool termina a parte em andamento
+            cancelled.set()
+            task['done'].wait()
+            self._release()
+
+    def _submit(self, fn, args, kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise InferenceQueueFull()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            self._ensure_threads()
+            # Os tempos por etapa continuam sendo acumulados na medição da requisição
+            task = {
+                'call': (fn, args, kwargs),
+                'timings': getattr(_stage_timings, 'current', None),
+                'submitted_at': time.perf_counter(),
+                'done': threading.Event(),
+            }
+            self._tasks.put(task)
+            return task
+        except Exception:
+            self._release()
+            raise
+
+    def _release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def _ensure_threads(self):
+        # As threads não sobrevivem ao fork: iniciar o pool uma vez por processo.
+        # São daemon para não bloquear o encerramento do worker.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._tasks = queue.Queue()
+                    for index in range(self.max_workers):
+                        threading.Thread(target=self._run, name=f'inference-{index}', daemon=True).start()
+                    self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            QUEUE_WAIT_SECONDS.labels(queue='executor').observe(time.perf_counter() - task['submitted_at'])
+            _stage_timings.current = task['timings']
+            fn, args, kwargs = task['call']
+            # Pico de RSS durante a tarefa, acima da memória no início. Com mais de uma thread de
+            # inferência as tarefas simultâneas zeram o pico umas das outras e a medida é aproximada.
+            baseline = process_memory().get('rss') if reset_peak_memory() else None
+            try:
+                task['result'] = fn(*args, **kwargs)
+            except Exception as e:
+                task['error'] = e
+            finally:
+                if baseline is not None:
+                    task['peak_memory'] = max(process_memory().get('peak', baseline) - baseline, 0)
+                _stage_timings.current = None
+                task['done'].set()
+
+inference_executor = InferenceExecutor(INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE)
+
+def _apply_mask(image, mask):
+    """Aplica a máscara como canal alfa sobre os pixels originais da imagem.
+    
+    Apenas a máscara (um canal) é ampliada para a resolução da imagem; as cores
+    não passam por nenhum redimensionamento.
+    """
+    with timed_stage('composite'):
+        if mask.size != image.size:
+            mask = mask.resize(image.size, Image.BILINEAR)
+        output_image = image.convert('RGBA') if image.mode != 'RGBA' else image.copy()
+        output_image.putalpha(mask)
+    return output_image
+
+def composite_on_background(foreground, alpha, background):
+    """Combina o primeiro plano sobre um fundo usando a máscara como opacidade.
+    
+    background pode ser uma cor (r, g, b) ou uma imagem, recortada e redimensionada para
+    cobrir o primeiro plano. O cálculo é feito em NumPy com inteiros de 16 bits.
+    """
+    with timed_stage('composite'):
+        if alpha.size != foreground.size:
+            alpha = alpha.resize(foreground.size, Image.BILINEAR)
+        if isinstance(background, Image.Image):
+            background = ImageOps.fit(background.convert('RGB'), foreground.size, Image.BILINEAR)
+        
+        a = np.asarray(alpha, dtype=np.uint16)[..., np.newaxis]
+        pixels = np.asarray(foreground.convert('RGB'), dtype=np.uint16) * a
+        # fg * a + bg * (255 - a) cabe em 16 bits: no máximo 255 * 255
+        pixels += np.asarray(background, dtype=np.uint16) * (255 - a)
+        pixels += 127
+        pixels //= 255
+        return Image.fromarray(pixels.astype(np.uint8), mode='RGB')
+
+def render_output(input_image, params, mask=None):
+    """Remove o fundo e codifica a imagem de saída.
+    
+    Com mask (reaproveitada de uma imagem quase idêntica), o modelo não é executado.
+    Retorna os bytes no formato pedido e a máscara usada, na resolução da imagem.
+    """
+    # A orientação EXIF é aplicada na própria imagem, sem uma cópia em memória
+    image = input_image
+    ImageOps.exif_transpose(image, in_place=True)
+    
+    if mask is None:
+        mask = predict_mask(image, rembg_sessions.get(params.get('model')))
+    with timed_stage('composite'):
+        if mask.size != image.size:
+            mask = mask.resize(image.size, Image.BILINEAR)
+    
+    if params.get('output', 'image') != 'image':
+        # Só a máscara foi pedida: a imagem recortada não precisa ser montada
+        return encode_output(mask, params), mask
+    
+    # Codificar uma única vez: os mesmos bytes vão para o cliente, para o disco e para o cache
+    return encode_output(_apply_mask(image, mask), params), mask
+
 # Função auxiliar para processamento de imagem
-def process_image_remove_bg(input_image):
+def process_image_remove_bg(input_image, model=None):
     """Função auxiliar para remover o fundo de uma imagem"""
-    # Redimensionar imagens muito grandes antes de processar
-    max_size = 2000  # Dimensão máxima para processamento
-    orig_width, orig_height = input_image.size
+    image = input_image
+    ImageOps.exif_transpose(image, in_place=True)
     
-    # Preservar a proporção original ao redimensionar
-    if orig_width > max_size or orig_height > max_size:
-        scale = min(max_size / orig_width, max_size / orig_height)
-        new_width = int(orig_width * scale)
-        new_height = int(orig_height * scale)
+    mask = predict_mask(image, rembg_sessions.get(model))
+    return _apply_mask(image, mask)
+
+def process_images_remove_bg(input_images, model=None):
+    """Remove o fundo de várias imagens com inferência em lote"""
+    output_images = dict(iter_images_remove_bg(input_images, model))
+    return [output_images[index] for index in range(len(input_images))]
+
+def iter_images_remove_bg(input_images, model=None):
+    """Remove o fundo de várias imagens com inferência em lote e gera (índice, imagem recortada)
+    assim que cada uma fica pronta, sem esperar as demais"""
+    session = rembg_sessions.get(model)
+    images = input_images
+    for image in images:
+        ImageOps.exif_transpose(image, in_place=True)
+    
+    # Imagens grandes são refinadas em blocos, uma por vez, depois das demais, que vão ao modelo em lote
+    small = [index for index, image in enumerate(images) if not uses_tiled_inference(*image.size)]
+    for offset in range(0, len(small), max(INFERENCE_BATCH_SIZE, 1)):
+        chunk = small[offset:offset + INFERENCE_BATCH_SIZE]
+        for index, mask in zip(chunk, predict_masks([images[index] for index in chunk], session)):
+            yield index, _apply_mask(images[index], mask)
+    
+    small = set(small)
+    for index, image in enumerate(images):
+        if index not in small:
+            yield index, _apply_mask(image, predict_mask_tiled(image, session))
+
+# Configuração de logs de segurança
+LOG_FOLDER = 'logs'
+os.makedirs(LOG_FOLDER, exist_ok=True)
+
+# Configurar logger principal
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Adicionar handler para arquivo com rotação
+handler = RotatingFileHandler(
+    os.path.join(LOG_FOLDER, 'app.log'),
+    maxBytes=10485760,  # 10MB
+    backupCount=10
+)
+handler.setFormatter(logging.Formatter(
+    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+))
+handler.setLevel(logging.INFO)
+logger.addHandler(handler)
+
+# Logger específico para eventos de segurança
+security_logger = logging.getLogger('security')
+security_logger.setLevel(logging.INFO)
+security_handler = RotatingFileHandler(
+    os.path.join(LOG_FOLDER, 'security.log'),
+    maxBytes=10485760,
+    backupCount=10
+)
+security_handler.setFormatter(logging.Formatter(
+    '%(asctime)s %(levelname)s: %(message)s [ip: %(remote_addr)s]'
+))
+security_logger.addHandler(security_handler)
+
+# Carregar configurações de um arquivo .env
+from dotenv import load_dotenv
+load_dotenv()
+
+app = Flask(__name__)
+app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_hex(32))
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limitar uploads a 16MB
+app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+app.config['API_KEYS'] = os.getenv('API_KEYS', '').split(',')
+
+# Aplicar ProxyFix para garantir que os endereços IP corretos sejam registrados
+app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
+
+def open_sqlite(path):
+    """Abre uma conexão com um banco SQLite local (uma por chamada, segura entre processos).
+    
+    Usada pelo armazenamento de resultados, pela fila de jobs, pelo limite de requisições e pelo
+    índice de quase duplicatas: autocommit (transações explícitas com BEGIN IMMEDIATE), WAL para
+    leituras concorrentes com uma escrita, e espera de até 30s por um banco bloqueado.
+    """
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+class SQLiteRateLimitStorage(Storage):
+    """Contadores do limitador de taxa em um banco SQLite, compartilhados entre processos.
+    
+    Registra o esquema sqlite:// no limits (sqlite:///caminho/relativo.db ou
+    sqlite:////caminho/absoluto.db). Cada incremento é uma única transação, de modo que
+    todos os workers do host consomem as mesmas cotas, e os contadores sobrevivem à
+    reciclagem dos workers.
+    """
+
+    STORAGE_SCHEME = ['sqlite']
+
+    def __init__(self, uri, wrap_exceptions=False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.db_path = urlparse(uri).path[1:] or 'ratelimit.db'
+        if os.path.dirname(self.db_path):
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = open_sqlite(self.db_path)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS counters (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            ''')
+        finally:
+            conn.close()
+
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+
+    def incr(self, key, expiry, elastic_expiry=False, amount=1):
+        now = time.time()
+        conn = open_sqlite(self.db_path)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Uma janela vencida recomeça do zero; elastic_expiry prorroga a janela a cada acesso
+            conn.execute(
+                '''INSERT INTO counters (key, value, expires_at) VALUES (?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET
+                       value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END,
+                       expires_at = CASE WHEN expires_at <= ? OR ? THEN excluded.expires_at ELSE expires_at END''',
+                (key, amount, now + expiry, now, now, bool(elastic_expiry))
+            )
+            value = conn.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()[0]
+            conn.execute('COMMIT')
+            return value
+        finally:
+            conn.close()
+
+    def get(self, key):
+        conn = open_sqlite(self.db_path)
+        try:
+            row = conn.execute(
+                'SELECT value FROM counters WHERE key = ? AND expires_at > ?', (key, time.time())
+            ).fetchone()
+            return row[0] if row else 0
+        finally:
+            conn.close()
+
+    def get_expiry(self, key):
+        conn = open_sqlite(self.db_path)
+        try:
+            row = conn.execute('SELECT expires_at FROM counters WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else time.time()
+        finally:
+            conn.close()
+
+    def check(self):
+        try:
+            conn = open_sqlite(self.db_path)
+            try:
+                conn.execute('SELECT 1 FROM counters LIMIT 1')
+            finally:
+                conn.close()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def reset(self):
+        conn = open_sqlite(self.db_path)
+        try:
+            return conn.execute('DELETE FROM counters').rowcount
+        finally:
+            conn.close()
+
+    def clear(self, key):
+        conn = open_sqlite(self.db_path)
+        try:
+            conn.execute('DELETE FROM counters WHERE key = ?', (key,))
+        finally:
+            conn.close()
+
+    def delete_expired(self):
+        """Remove os contadores de janelas já encerradas"""
+        conn = open_sqlite(self.db_path)
+        try:
+            return conn.execute('DELETE FROM counters WHERE expires_at <= ?', (time.time(),)).rowcount
+        finally:
+            conn.close()
+
+def request_api_key():
+    """API key enviada no cabeçalho X-API-Key ou no parâmetro api_key"""
+    return request.headers.get('X-API-Key', '') or request.args.get('api_key', '')
+
+def rate_limit_key():
+    """Chave dos limites de taxa: a API key, quando válida, ou o IP do cliente.
+    
+    A API key entra resumida por hash para não ser gravada no armazenamento dos limites.
+    Chaves inválidas contam pelo IP, para que não seja possível obter cotas novas
+    trocando a chave enviada.
+    """
+    api_key = request_api_key()
+    if api_key and (not app.config['API_KEYS'] or api_key in app.config['API_KEYS']):
+        return 'key:' + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return get_remote_address()
+
+def upload_megapixels():
+    """Custo de uma requisição em megapixels (arredondado para cima, no mínimo 1).
+    
+    Apenas os cabeçalhos das imagens enviadas são lidos; os arquivos voltam ao início
+    para o processamento normal. Nas rotas que aceitam URLs, as imagens remotas são baixadas
+    aqui e também contam.
+    """
+    if 'upload_megapixels' not in g:
+        files = [file for _, file in request.files.items(multi=True)]
+        if request.endpoint in REMOTE_URL_ENDPOINTS:
+            try:
+                files += [file for file in remote_uploads() if isinstance(file, FileStorage)]
+            except RemoteURLError:
+                pass  # Recusado pela própria rota
+        pixels = 0
+        for file in files:
+            try:
+                with Image.open(file.stream) as image:
+                    pixels += image.width * image.height
+            except Exception:
+                pass  # Arquivos inválidos são recusados pela própria rota
+            finally:
+                file.stream.seek(0)
+        g.upload_megapixels = max(1, math.ceil(pixels / 1e6))
+    return g.upload_megapixels
+
+# Configurar limitador de taxa: contadores compartilhados entre os workers (SQLite no host
+# ou, com vários servidores, um Redis em RATELIMIT_STORAGE_URI)
+RATELIMIT_STORAGE_URI = os.getenv('RATELIMIT_STORAGE_URI', 'sqlite:///processed/ratelimit.db')
+RATE_LIMIT_MEGAPIXELS = os.getenv('RATE_LIMIT_MEGAPIXELS', '500 per hour')  # Cota por API key
+
+limiter = Limiter(
+    app=app,
+    key_func=rate_limit_key,
+    default_limits=["200 per day", "50 per hour"],
+    storage_uri=RATELIMIT_STORAGE_URI,
+    headers_enabled=True,
+)
+
+# Cota de processamento compartilhada pelas rotas que executam o modelo ou compõem imagens
+megapixel_limit = limiter.shared_limit(RATE_LIMIT_MEGAPIXELS, scope='megapixels', cost=upload_megapixels)
+
+# Pasta para armazenar imagens processadas
+UPLOAD_FOLDER = 'uploads'
+PROCESSED_FOLDER = 'processed'
+
+# Criar pastas se não existirem
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(PROCESSED_FOLDER, exist_ok=True)
+
+# Cache de resultados (memória + disco), indexado pelo hash da entrada e dos parâmetros
+RESULT_CACHE_FOLDER = os.path.join(PROCESSED_FOLDER, 'cache')
+RESULT_CACHE_MEMORY_BYTES = int(os.getenv('RESULT_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))  # 64MB
+RESULT_CACHE_DISK_BYTES = int(os.getenv('RESULT_CACHE_DISK_BYTES', 256 * 1024 * 1024))  # 256MB
+
+class ResultCache:
+    """Cache LRU em memória limitado por bytes, com uma segunda camada em disco.
+    
+    A camada em disco é compartilhada pelos processos: o total de bytes em disco fica em um
+    banco SQLite na própria pasta, somado por todos os workers a cada gravação.
+    """
+
+    def __init__(self, folder, memory_max_bytes, disk_max_bytes):
+        self.folder = folder
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.db_path = os.path.join(folder, 'usage.db')
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        if disk_max_bytes > 0:
+            conn = open_sqlite(self.db_path)
+            try:
+                conn.execute('CREATE TABLE IF NOT EXISTS disk_usage (id INTEGER PRIMARY KEY, total INTEGER)')
+                # Total desconhecido (NULL): recalculado pela pasta na próxima gravação
+                conn.execute('INSERT OR REPLACE INTO disk_usage (id, total) VALUES (0, NULL)')
+            finally:
+                conn.close()
+
+    @staticmethod
+    def make_key(data, **params):
+        """Gera a chave do cache a partir dos bytes enviados e dos parâmetros de processamento"""
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.folder, f"{key}.bin")
+
+    def get(self, key):
+        """Retorna os bytes do resultado ou None se a chave não estiver no cache"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                CACHE_LOOKUPS_TOTAL.labels(result='hit_memory').inc()
+                return data
+
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # Marcar como usado recentemente para a remoção por idade
+        except OSError:
+            CACHE_LOOKUPS_TOTAL.labels(result='miss').inc()
+            return None
+        
+        CACHE_LOOKUPS_TOTAL.labels(result='hit_disk').inc()
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        """Armazena o resultado nas duas camadas do cache"""
+        self._put_memory(key, data)
+        self._put_disk(key, data)
+
+    def _put_memory(self, key, data):
+        if len(data) > self.memory_max_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous)
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def _put_disk(self, key, data):
+        if self.disk_max_bytes <= 0 or len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with timed_stage('disk_write'):
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Erro ao gravar no cache de resultados: {str(e)}")
+            return
+
+        # Uma transação por gravação: o total inclui as gravações de todos os workers, e só um
+        # processo por vez remove entradas
+        try:
+            conn = open_sqlite(self.db_path)
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    total = conn.execute('SELECT total FROM disk_usage WHERE id = 0').fetchone()['total']
+                    total = self._scan_disk()[1] if total is None else total + len(data)
+                    if total > self.disk_max_bytes:
+                        total = self._evict_disk()
+                    conn.execute('UPDATE disk_usage SET total = ? WHERE id = 0', (total,))
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+            finally:
+                conn.close()
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Erro ao atualizar o uso do cache de resultados: {str(e)}")
+
+    def _scan_disk(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.name.endswith('.bin'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        return entries, total
+
+    def _evict_disk(self):
+        """Remove as entradas menos usadas até ficar abaixo de 90% do limite em disco; retorna o total restante"""
+        entries, total = self._scan_disk()
+        target = self.disk_max_bytes * 0.9
+        count = 0
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                count += 1
+            except OSError:
+                pass
+        if count > 0:
+            logger.info(f"Cache de resultados: {count} entradas removidas do disco")
+        return total
+
+result_cache = ResultCache(RESULT_CACHE_FOLDER, RESULT_CACHE_MEMORY_BYTES, RESULT_CACHE_DISK_BYTES)
+
+# Reaproveitamento de máscaras de imagens quase idênticas (reenviadas com outra compressão ou tamanho)
+NEAR_DUPLICATE_THRESHOLD = int(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0'))  # Bits diferentes no dHash; 0 = desativado
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv('NEAR_DUPLICATE_MAX_ENTRIES', '1000'))
+NEAR_DUPLICATE_ASPECT_TOLERANCE = 0.01  # Diferença relativa máxima da proporção largura/altura
+
+# Transposição correspondente a cada valor da orientação EXIF (como em ImageOps.exif_transpose)
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+class NearDuplicateIndex:
+    """Índice de hashes perceptuais das imagens processadas, com as máscaras calculadas.
+    
+    Cada imagem é resumida por um dHash de 64 bits e pela proporção largura/altura. Os
+    registros ficam em um banco SQLite compartilhado pelos processos e as máscaras em
+    PNG ao lado dele; cada processo mantém uma cópia do índice em arrays NumPy, atualizada
+    com os registros novos a cada consulta, e compara os hashes pela distância de Hamming.
+    """
+
+    def __init__(self, folder, threshold, max_entries):
+        self.folder = folder
+        self.db_path = os.path.join(folder, 'index.db')
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._aspects = np.empty(0, dtype=np.float32)
+        self._models = np.empty(0, dtype=object)
+        if self.enabled:
+            os.makedirs(folder, exist_ok=True)
+            self._init_db()
+
+    @property
+    def enabled(self):
+        return self.threshold > 0 and self.max_entries > 0
+
+    @staticmethod
+    def image_key(image):
+        """dHash de 64 bits e proporção da imagem, na orientação indicada pelo EXIF"""
+        with timed_stage('near_duplicate'):
+            # Reduzir primeiro a imagem inteira; a orientação é aplicada só à miniatura
+            small = image.resize((32, 32), Image.BOX, reducing_gap=2.0).convert('L')
+            width, height = image.size
+            transpose = EXIF_ORIENTATION_TRANSPOSE.get(image.getexif().get(0x0112))
+            if transpose is not None:
+                small = small.transpose(transpose)
+                if transpose in (Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE,
+                                 Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270):
+                    width, height = height, width
+            pixels = np.asarray(small.resize((9, 8), Image.BOX), dtype=np.int16)
+            bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+            dhash = int(np.packbits(bits).view('>u8')[0])
+        return dhash, width / height
+
+    def _init_db(self):
+        conn = open_sqlite(self.db_path)
+        try:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS masks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dhash INTEGER NOT NULL,
+                    aspect REAL NOT NULL,
+                    model TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            ''')
+        finally:
+            conn.close()
+
+    def _mask_path(self, entry_id):
+        return os.path.join(self.folder, f"{entry_id}.png")
+
+    def _sync(self):
+        """Acrescenta aos arrays os registros gravados por qualquer processo desde a última consulta"""
+        conn = open_sqlite(self.db_path)
+        try:
+            rows = conn.execute(
+                'SELECT id, dhash, aspect, model FROM masks WHERE id > ? ORDER BY id', (self._last_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
         
-        # Redimensionar para economizar memória
-        resized_image = input_image.resize((new_width, new_height), Image.LANCZOS)
+        ids, hashes, aspects, models = zip(*rows)
+        # O SQLite guarda inteiros de 64 bits com sinal: o hash volta a ser sem sinal pela mesma representação
+        self._ids = np.concatenate([self._ids, np.array(ids, dtype=np.int64)])[-self.max_entries:]
+        self._hashes = np.concatenate([self._hashes, np.array(hashes, dtype=np.int64).view(np.uint64)])[-self.max_entries:]
+        self._aspects = np.concatenate([self._aspects, np.array(aspects, dtype=np.float32)])[-self.max_entries:]
+        self._models = np.concatenate([self._models, np.array(models, dtype=object)])[-self.max_entries:]
+        self._last_id = ids[-1]
+
+    def find(self, key, model):
+        """Retorna a máscara (modo L) da imagem mais parecida dentro do limite, ou None"""
+        dhash, aspect = key
+        with timed_stage('near_duplicate'):
+            with self._lock:
+                self._sync()
+                distances = POPCOUNT_TABLE[(self._hashes ^ np.uint64(dhash)).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+                candidates = (
+                    (distances <= self.threshold)
+                    & (np.abs(self._aspects - aspect) <= aspect * NEAR_DUPLICATE_ASPECT_TOLERANCE)
+                    & (self._models == model)
+                )
+                order = np.argsort(np.where(candidates, distances, 65))[:int(candidates.sum())]
+                entry_ids = self._ids[order].tolist()
+            
+            for entry_id in entry_ids:
+                try:
+                    mask = Image.open(self._mask_path(entry_id))
+                    mask.load()
+                    return mask
+                except OSError:
+                    continue  # Máscara removida por outro processo
+        return None
+
+    def add(self, key, model, mask):
+        """Registra a máscara calculada para a imagem e remove as entradas mais antigas acima do limite"""
+        dhash, aspect = key
+        conn = open_sqlite(self.db_path)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            entry_id = conn.execute(
+                'INSERT INTO masks (dhash, aspect, model, created_at) VALUES (?, ?, ?, ?)',
+                (int(np.uint64(dhash).view(np.int64)), aspect, model, time.time())
+            ).lastrowid
+            # A máscara é gravada antes do commit: outros processos só veem o registro com o arquivo pronto
+            with timed_stage('disk_write'):
+                mask.save(self._mask_path(entry_id), format='PNG', compress_level=1)
+            expired = [row[0] for row in conn.execute(
+                'SELECT id FROM masks ORDER BY id DESC LIMIT -1 OFFSET ?', (self.max_entries,)
+            )]
+            conn.executemany('DELETE FROM masks WHERE id = ?', [(expired_id,) for expired_id in expired])
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
         
-        # Liberar memória da imagem original
-        del input_image
+        for expired_id in expired:
+            with contextlib.suppress(OSError):
+                os.remove(self._mask_path(expired_id))
+
+near_duplicates = NearDuplicateIndex(
+    os.path.join(RESULT_CACHE_FOLDER, 'near'), NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_MAX_ENTRIES
+)
+
+# Armazenamento dos resultados: subdiretórios pelo hash do ID e um índice SQLite com validade e tamanho
+STORAGE_DB_PATH = os.getenv('STORAGE_DB_PATH', os.path.join(PROCESSED_FOLDER, 'storage.db'))
+STORAGE_TTL_HOURS = float(os.getenv('STORAGE_TTL_HOURS', '24'))
+STORAGE_MAX_BYTES = int(os.getenv('STORAGE_MAX_BYTES', 512 * 1024 * 1024))  # 512MB
+
+def delete_legacy_files(directory, suffix, max_age_hours):
+    """Remove os arquivos do layout anterior ao índice mais antigos que max_age_hours.
+    
+    Antes do índice, resultados (<id>_output.<ext>) e entradas (<id>_input.<ext>) ficavam
+    soltos em processed/ e uploads/, fora do alcance da validade e do limite de espaço.
+    Só os arquivos diretamente em directory cujo nome termina em suffix são considerados.
+    """
+    cutoff = time.time() - max_age_hours * 3600
+    count = 0
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and os.path.splitext(entry.name)[0].endswith(suffix) \
+                        and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    count += 1
+    except OSError as e:
+        logger.error(f"Erro na limpeza de arquivos antigos de {directory}: {str(e)}")
+    if count > 0:
+        logger.info(f"Limpeza de arquivos: {count} arquivos do layout anterior removidos de {directory}")
+    return count
+
+class ResultStorage:
+    """Arquivos de resultado em subdiretórios pelo hash do ID, registrados em um índice SQLite.
+    
+    O índice guarda tamanho, criação, validade, formato e hash do conteúdo de cada arquivo:
+    a busca por ID, a remoção dos expirados e o limite de espaço não percorrem os diretórios.
+    """
+
+    def __init__(self, folder, db_path, ttl_hours, max_bytes):
+        self.folder = folder
+        self.db_path = db_path
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        self._init_db()
+
+    def _init_db(self):
+        conn = open_sqlite(self.db_path)
+        try:
+            conn.executescript('''
+                CREATE TABLE IF NOT EXISTS files (
+                    id TEXT PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    format TEXT NOT NULL,
+                    content_hash TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS idx_files_expires ON files (expires_at);
+                CREATE INDEX IF NOT EXISTS idx_files_created ON files (created_at);
+                CREATE INDEX IF NOT EXISTS idx_files_hash ON files (content_hash);
+            ''')
+        finally:
+            conn.close()
+
+    def _path(self, file_id, output_format):
+        # Dois níveis de subdiretórios (256 x 256) mantêm cada diretório pequeno
+        digest = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+        ext = RLE_EXTENSION if output_format == 'rle' else OUTPUT_FORMATS[output_format][2]
+        return os.path.join(self.folder, digest[:2], digest[2:4], f"{file_id}_output{ext}")
+
+    def save(self, file_id, data, output_format):
+        """Grava o resultado, registra-o no índice e aplica o limite de espaço.
+        
+        Se já existe um arquivo com o mesmo conteúdo (um resultado servido do cache, por
+        exemplo), o novo ID apenas aponta para ele no índice, sem gravar outra cópia.
+        Retorna o caminho do arquivo e o hash SHA-256 do conteúdo.
+        """
+        content_hash = hashlib.sha256(data).hexdigest()
+        conn = open_sqlite(self.db_path)
+        try:
+            path = self._add_alias(conn, file_id, output_format, content_hash)
+            if path is None:
+                path = self._path(file_id, output_format)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_output_file(path, data)
+                self._insert(conn, file_id, path, len(data), output_format, content_hash)
+            if self.max_bytes > 0:
+                self._enforce_quota(conn)
+        finally:
+            conn.close()
+        return path, content_hash
+
+    def _insert(self, conn, file_id, path, size, output_format, content_hash):
+        now = time.time()
+        conn.execute(
+            'INSERT OR REPLACE INTO files (id, path, size, created_at, expires_at, format, content_hash) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (file_id, path, size, now, now + self.ttl, output_format, content_hash)
+        )
+
+    def _add_alias(self, conn, file_id, output_format, content_hash):
+        """Registra file_id apontando para um arquivo já gravado com o mesmo conteúdo.
+        
+        Retorna o caminho desse arquivo, ou None se não houver nenhum.
+        """
+        if conn.execute(
+            'SELECT 1 FROM files WHERE content_hash = ? AND format = ? LIMIT 1', (content_hash, output_format)
+        ).fetchone() is None:
+            return None
+        
+        # Na mesma transação que as remoções (ver _delete): o arquivo não pode sumir no meio
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT path, size FROM files WHERE content_hash = ? AND format = ? LIMIT 1',
+                (content_hash, output_format)
+            ).fetchone()
+            if row is None or not os.path.exists(row['path']):
+                conn.execute('ROLLBACK')
+                return None
+            self._insert(conn, file_id, row['path'], row['size'], output_format, content_hash)
+            conn.execute('COMMIT')
+            return row['path']
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _select(self, where, args):
+        conn = open_sqlite(self.db_path)
+        try:
+            return conn.execute(
+                f'SELECT id, path, size, format, content_hash FROM files WHERE {where} AND expires_at > ?',
+                (*args, time.time())
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def lookup(self, file_id):
+        """Retorna o registro (path, size, format, content_hash) de um resultado válido, ou None"""
+        rows = self._select('id = ?', (file_id,))
+        return rows[0] if rows else None
+
+    def lookup_hash(self, content_hash):
+        """Retorna o registro de um resultado válido com o conteúdo indicado, ou None"""
+        rows = self._select('content_hash = ?', (content_hash,))
+        return rows[0] if rows else None
+
+    def lookup_many(self, file_ids):
+        """Retorna {id: registro} dos resultados válidos entre os IDs indicados"""
+        if not file_ids:
+            return {}
+        rows = self._select(f"id IN ({', '.join('?' * len(file_ids))})", tuple(file_ids))
+        return {row['id']: row for row in rows}
+
+    def _delete(self, conn, where, args):
+        """Remove do índice as linhas selecionadas e, depois do commit, os arquivos que
+        nenhuma outra linha (ID com o mesmo conteúdo) ainda referencia"""
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            paths = {row['path'] for row in conn.execute(f'SELECT path FROM files WHERE {where}', args)}
+            count = conn.execute(f'DELETE FROM files WHERE {where}', args).rowcount
+            orphans = [
+                path for path in paths
+                if conn.execute('SELECT 1 FROM files WHERE path = ? LIMIT 1', (path,)).fetchone() is None
+            ]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        for path in orphans:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return count
+
+    def _enforce_quota(self, conn):
+        """Remove os resultados mais antigos até ficar abaixo de 90% do limite de espaço"""
+        # Cada arquivo conta uma vez, mesmo com vários IDs, pela data do ID mais novo
+        files = 'SELECT MAX(created_at) AS created_at, MAX(size) AS size FROM files GROUP BY path'
+        total = conn.execute(f'SELECT COALESCE(SUM(size), 0) FROM ({files})').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        # Data de criação do resultado mais novo a remover para liberar o excedente
+        excess = total - self.max_bytes * 0.9
+        cutoff = None
+        for row in conn.execute(f'{files} ORDER BY created_at'):
+            excess -= row['size']
+            cutoff = row['created_at']
+            if excess <= 0:
+                break
+        count = self._delete(conn, 'created_at <= ?', (cutoff,))
+        logger.info(f"Armazenamento: {count} resultados removidos pelo limite de {self.max_bytes} bytes")
+
+    def delete_expired(self):
+        """Remove os resultados vencidos (consulta pelo índice de validade) e os do layout anterior"""
+        delete_legacy_files(self.folder, '_output', self.ttl / 3600)
+        try:
+            conn = open_sqlite(self.db_path)
+            try:
+                count = self._delete(conn, 'expires_at <= ?', (time.time(),))
+            finally:
+                conn.close()
+            if count > 0:
+                logger.info(f"Limpeza de arquivos: {count} resultados expirados removidos")
+        except Exception as e:
+            logger.error(f"Erro na limpeza de arquivos: {str(e)}")
+
+result_storage = ResultStorage(PROCESSED_FOLDER, STORAGE_DB_PATH, STORAGE_TTL_HOURS, STORAGE_MAX_BYTES)
+
+# Envio dos resultados: com X_ACCEL_REDIRECT_PREFIX (location interna do nginx apontando para processed/)
+# ou USE_X_SENDFILE (Apache, lighttpd), o servidor web envia o arquivo em vez do worker Python
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '')
+app.config['USE_X_SENDFILE'] = os.getenv('USE_X_SENDFILE', 'False').lower() in ('true', '1')
+RESULT_MAX_AGE = int(os.getenv('RESULT_MAX_AGE', 365 * 24 * 3600))  # URLs imutáveis por hash
+
+# Rotas que servem resultados armazenados e definem o próprio Cache-Control
+RESULT_ENDPOINTS = ('get_result', 'download_processed_image')
+
+# Fila de jobs assíncronos para processamento em lote (SQLite, sem serviços externos)
+JOBS_DB_PATH = os.getenv('JOBS_DB_PATH', os.path.join(PROCESSED_FOLDER, 'jobs.db'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))
+BATCH_MAX_FILES = 5  # Modos síncrono e streaming (reduzido de 10 para 5)
+BATCH_MAX_FILES_ASYNC = int(os.getenv('BATCH_MAX_FILES_ASYNC', '50'))
+JOB_POLL_INTERVAL = 0.5  # Segundos entre consultas à fila quando ela está vazia
+JOB_STALE_SECONDS = 600  # Itens em processamento há mais tempo que isso são devolvidos à fila
+JOB_SUPERVISOR_INTERVAL = 5  # Segundos entre verificações dos processos de jobs pelo supervisor
+JOB_MAX_ATTEMPTS = 3  # Itens que derrubaram o worker de jobs esse número de vezes são marcados como falha
+
+def iter_batch_outputs(streams, params, max_images=None):
+    """Processa os arquivos de um lote e gera os resultados na ordem em que ficam prontos.
+    
+    Os resultados em cache saem imediatamente; as demais imagens passam juntas pela
+    inferência em lote, em partes que cabem em MAX_REQUEST_PIXELS e, se informado, com no
+    máximo max_images imagens. Cada resultado sai assim que é codificado.
+    params são os parâmetros de processamento (ver get_processing_params).
+    Gera (índice, (dados codificados, cached)) ou (índice, exceção ocorrida).
+    """
+    pending = []
+    
+    def process_pending():
+        """Processa as imagens decodificadas até aqui e libera a memória delas"""
+        logger.info(f"Processando {len(pending)} imagens em lote")
+        images = list(pending)
+        pending.clear()
+        remaining = set(range(len(images)))
+        try:
+            for position, output_image in iter_images_remove_bg([image for _, _, image in images], params.get('model')):
+                remaining.discard(position)
+                index, cache_key, _ = images[position]
+                try:
+                    output_data = encode_output(output_image, params)
+                    result_cache.put(cache_key, output_data)
+                except Exception as e:
+                    yield index, e
+                    continue
+                yield index, (output_data, False)
+        except Exception as e:
+            for position in sorted(remaining):
+                yield images[position][0], e
+    
+    # Reaproveitar resultados já calculados para o mesmo conteúdo: todos saem antes da inferência
+    misses = []
+    for index, stream in enumerate(streams):
+        try:
+            input_data = stream.read()
+            stream.seek(0)
+            cache_key = ResultCache.make_key(input_data, **params)
+            del input_data
+            cached_output = result_cache.get(cache_key)
+        except Exception as e:
+            yield index, e
+            continue
+        if cached_output is not None:
+            yield index, (cached_output, True)
+        else:
+            misses.append((index, stream, cache_key))
+    
+    pending_pixels = 0
+    for index, stream, cache_key in misses:
+        try:
+            # Validar pelo cabeçalho; se a imagem não couber no orçamento de pixels junto com as
+            # já decodificadas, estas são processadas antes
+            image = open_upload_image(stream, max_size=params['max_size'])
+            pixels = image.width * image.height
+            if pending and pending_pixels + pixels > MAX_REQUEST_PIXELS:
+                yield from process_pending()
+                pending_pixels = 0
+            
+            pending.append((index, cache_key, decode_upload_image(image, params['max_size'])))
+            pending_pixels += pixels
+            if max_images and len(pending) >= max_images:
+                yield from process_pending()
+                pending_pixels = 0
+        except Exception as e:
+            yield index, e
+    
+    if pending:
+        yield from process_pending()
+
+def process_batch_files(streams, params):
+    """Processa os arquivos de um lote e grava os resultados em PROCESSED_FOLDER.
+    
+    Retorna, para cada arquivo, (file_id, output_path, cached, content_hash) ou a exceção ocorrida.
+    """
+    results = [None] * len(streams)
+    for index, result in iter_batch_outputs(streams, params):
+        if isinstance(result, Exception):
+            results[index] = result
+            continue
+        try:
+            # Codificado uma única vez: apenas a saída é salva, para economizar espaço
+            output_data, cached = result
+            file_id = str(uuid.uuid4())
+            output_path, content_hash = result_storage.save(file_id, output_data, output_format(params))
+            results[index] = (file_id, output_path, cached, content_hash)
+        except Exception as e:
+            results[index] = e
+    return results
+
+def get_jobs_db():
+    """Abre uma conexão com o banco da fila de jobs"""
+    return open_sqlite(JOBS_DB_PATH)
+
+def init_jobs_db():
+    """Cria as tabelas da fila de jobs, se ainda não existirem"""
+    conn = get_jobs_db()
+    try:
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                created_at REAL NOT NULL,
+                total INTEGER NOT NULL,
+                params TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                original_name TEXT NOT NULL,
+                input_path TEXT,
+                status TEXT NOT NULL,
+                file_id TEXT,
+                cached INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                claimed_at REAL,
+                finished_at REAL,
+                worker_pid INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_job_items_job ON job_items (job_id);
+            CREATE INDEX IF NOT EXISTS idx_job_items_status ON job_items (status, id);
+            CREATE TABLE IF NOT EXISTS job_workers (
+                pid INTEGER PRIMARY KEY,
+                started_at REAL NOT NULL,
+                seen_at REAL NOT NULL
+            );
+        ''')
+    finally:
+        conn.close()
+
+def enqueue_job(job_id, items, params):
+    """Registra um job e seus itens; items é uma lista de (original_name, input_path, status, error)"""
+    now = time.time()
+    conn = get_jobs_db()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute(
+            'INSERT INTO jobs (id, created_at, total, params) VALUES (?, ?, ?, ?)',
+            (job_id, now, len(items), json.dumps(params, sort_keys=True))
+        )
+        conn.executemany(
+            'INSERT INTO job_items (job_id, position, original_name, input_path, status, error, finished_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [
+                (job_id, position, name, path, status, error, now if status == 'failed' else None)
+                for position, (name, path, status, error) in enumerate(items)
+            ]
+        )
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+def claim_job_items(conn, limit):
+    """Reserva até limit itens da fila para este processo (lista vazia se a fila estiver vazia)"""
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rows = conn.execute(
+            "SELECT job_items.*, jobs.params, jobs.created_at FROM job_items JOIN jobs ON jobs.id = job_items.job_id "
+            "WHERE job_items.status = 'queued' "
+            "OR (job_items.status = 'processing' AND job_items.claimed_at < ?) ORDER BY job_items.id LIMIT ?",
+            (now - JOB_STALE_SECONDS, limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE job_items SET status = 'processing', claimed_at = ?, worker_pid = ?, attempts = attempts + 1 "
+            "WHERE id = ?",
+            [(now, os.getpid(), row['id']) for row in rows]
+        )
+        conn.execute('COMMIT')
+        for row in rows:
+            QUEUE_WAIT_SECONDS.labels(queue='jobs').observe(now - row['created_at'])
+        return rows
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+def run_job_items(conn, items):
+    """Processa itens reservados da fila (de jobs com os mesmos parâmetros) em um único lote"""
+    streams = []
+    try:
+        for item in items:
+            streams.append(open(item['input_path'], 'rb'))
+        results = process_batch_files(streams, json.loads(items[0]['params']))
+    except Exception as e:
+        results = [e] * len(items)
+    finally:
+        for stream in streams:
+            stream.close()
+    
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            logger.error(f"Erro ao processar item {item['id']} do job {item['job_id']}: {str(result)}")
+            conn.execute(
+                "UPDATE job_items SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                (str(result), time.time(), item['id'])
+            )
+        else:
+            file_id, _, cached, _ = result
+            conn.execute(
+                "UPDATE job_items SET status = 'done', file_id = ?, cached = ?, finished_at = ? WHERE id = ?",
+                (file_id, int(cached), time.time(), item['id'])
+            )
+        
+        # O arquivo de entrada não é mais necessário depois do processamento
+        try:
+            os.remove(item['input_path'])
+        except OSError:
+            pass
+
+def job_worker_loop():
+    """Laço principal de um processo worker de jobs; termina se o processo que o criou deixar de existir"""
+    parent_pid = os.getppid()
+    init_jobs_db()
+    conn = get_jobs_db()
+    logger.info(f"Worker de jobs iniciado (pid {os.getpid()})")
+    while os.getppid() == parent_pid:
+        try:
+            items = claim_job_items(conn, max(INFERENCE_BATCH_SIZE, 1))
+        except sqlite3.OperationalError as e:
+            logger.error(f"Erro ao consultar a fila de jobs: {str(e)}")
+            items = []
+        if not items:
+            time.sleep(JOB_POLL_INTERVAL)
+            continue
+        
+        # Itens de jobs com parâmetros diferentes são processados em lotes separados
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(item['params'], []).append(item)
+        for group in groups.values():
+            run_job_items(conn, group)
+
+def requeue_job_items(conn, pid):
+    """Devolve à fila os itens reservados por um worker de jobs encerrado.
+    
+    Itens que já derrubaram o worker JOB_MAX_ATTEMPTS vezes são marcados como falha, para que
+    uma imagem problemática não reinicie os workers indefinidamente. Retorna (devolvidos, falhas).
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        failed = conn.execute(
+            "UPDATE job_items SET status = 'failed', error = ?, finished_at = ?, worker_pid = NULL "
+            "WHERE status = 'processing' AND worker_pid = ? AND attempts >= ?",
+            ('O processamento desta imagem interrompeu o worker de jobs', now, pid, JOB_MAX_ATTEMPTS)
+        ).rowcount
+        requeued = conn.execute(
+            "UPDATE job_items SET status = 'queued', claimed_at = NULL, worker_pid = NULL "
+            "WHERE status = 'processing' AND worker_pid = ?",
+            (pid,)
+        ).rowcount
+        conn.execute('DELETE FROM job_workers WHERE pid = ?', (pid,))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return requeued, failed
+
+def spawn_job_worker(context, conn):
+    """Inicia um processo worker de jobs e o registra no banco da fila"""
+    process = context.Process(target=job_worker_loop, name='job-worker', daemon=True)
+    process.start()
+    now = time.time()
+    conn.execute(
+        'INSERT OR REPLACE INTO job_workers (pid, started_at, seen_at) VALUES (?, ?, ?)',
+        (process.pid, now, now)
+    )
+    return process
+
+def start_job_workers(context, count=JOB_WORKERS):
+    """Inicia os processos que consomem a fila de jobs"""
+    init_jobs_db()
+    conn = get_jobs_db()
+    try:
+        # Registros de uma execução anterior do servidor: esses processos não existem mais
+        for row in conn.execute('SELECT pid FROM job_workers').fetchall():
+            requeue_job_items(conn, row['pid'])
+        processes = [spawn_job_worker(context, conn) for _ in range(count)]
+    finally:
+        conn.close()
+    logger.info(f"{count} workers de jobs iniciados")
+    return processes
+
+def supervise_job_workers(context, processes, parent_pid):
+    """Laço do supervisor: substitui workers de jobs encerrados e devolve à fila os itens deles.
+    
+    Termina quando o processo que iniciou o servidor (parent_pid) deixa de existir.
+    """
+    conn = get_jobs_db()
+    while os.getppid() == parent_pid:
+        time.sleep(JOB_SUPERVISOR_INTERVAL)
+        try:
+            for index, process in enumerate(processes):
+                if process.is_alive():
+                    conn.execute('UPDATE job_workers SET seen_at = ? WHERE pid = ?', (time.time(), process.pid))
+                    continue
+                requeued, failed = requeue_job_items(conn, process.pid)
+                logger.error(
+                    f"Worker de jobs {process.pid} encerrado (código {process.exitcode}): "
+                    f"{requeued} itens devolvidos à fila, {failed} marcados como falha; reiniciando"
+                )
+                processes[index] = spawn_job_worker(context, conn)
+        except Exception as e:
+            logger.error(f"Erro no supervisor de workers de jobs: {str(e)}")
+
+def background_services_main(parent_pid):
+    """Processo auxiliar: limpeza periódica, workers da fila de jobs e o supervisor que os reinicia"""
+    # SIGTERM do servidor: sair pelo caminho normal, que também termina os workers de jobs (daemon)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    context = multiprocessing.get_context('spawn')
+    schedule_cleanup(app)
+    supervise_job_workers(context, start_job_workers(context), parent_pid)
+
+def start_background_services():
+    """Inicia o processo auxiliar com a limpeza e os workers de jobs; retorna o processo.
+    
+    Chamada uma vez por servidor: no master do Gunicorn (when_ready) ou em python app.py.
+    O master cria os workers HTTP por fork e não deve ter threads próprias (um fork copiaria
+    travas em uso), então a limpeza e o supervisor rodam em um processo criado com spawn,
+    que importa o app e o rembg por conta própria. O processo não é daemon, pois cria os
+    workers de jobs: quem o inicia deve terminá-lo ao encerrar (ver on_exit no gunicorn_config.py).
+    """
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(target=background_services_main, args=(os.getpid(),), name='background-services')
+    process.start()
+    return process
+
+def job_workers_online():
+    """Indica se algum worker de jobs foi visto pelo supervisor recentemente"""
+    conn = get_jobs_db()
+    try:
+        row = conn.execute(
+            'SELECT COUNT(*) AS count FROM job_workers WHERE seen_at > ?',
+            (time.time() - 3 * JOB_SUPERVISOR_INTERVAL,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row['count'] > 0
+
+def get_job(job_id):
+    """Retorna o estado de um job e de seus itens, ou None se o job não existir"""
+    conn = get_jobs_db()
+    try:
+        job = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job is None:
+            return None
+        items = conn.execute(
+            'SELECT * FROM job_items WHERE job_id = ? ORDER BY position', (job_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return job, items
+
+def cleanup_old_jobs(max_age_hours=24):
+    """Remove jobs mais antigos que max_age_hours, seus itens e os arquivos de entrada restantes"""
+    try:
+        cutoff = time.time() - max_age_hours * 3600
+        conn = get_jobs_db()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # Entradas de itens não concluídos (ex.: worker interrompido) ainda estão em UPLOAD_FOLDER
+            input_paths = [row['input_path'] for row in conn.execute(
+                "SELECT input_path FROM job_items WHERE status != 'done' AND input_path IS NOT NULL "
+                "AND job_id IN (SELECT id FROM jobs WHERE created_at < ?)", (cutoff,)
+            )]
+            conn.execute('DELETE FROM job_items WHERE job_id IN (SELECT id FROM jobs WHERE created_at < ?)', (cutoff,))
+            count = conn.execute('DELETE FROM jobs WHERE created_at < ?', (cutoff,)).rowcount
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        for path in input_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if count > 0:
+            logger.info(f"Limpeza de jobs: {count} jobs removidos")
+    except Exception as e:
+        logger.error(f"Erro na limpeza de jobs: {str(e)}")
+
+init_jobs_db()
+
+# Dimensão máxima (largura ou altura) aceita para imagens enviadas; acima de
+# TILED_INFERENCE_THRESHOLD a máscara é refinada em blocos
+MAX_IMAGE_DIMENSION = int(os.getenv('MAX_IMAGE_DIMENSION', '8000'))
+
+class InvalidImageError(Exception):
+    """Erro de validação de uma imagem enviada, com mensagem destinada ao cliente"""
+
+class OversizedImageError(InvalidImageError):
+    """Imagem com dimensões acima do limite permitido"""
+
+# Orçamento de pixels decodificados por requisição: imagens acima dele são recusadas antes da
+# decodificação e os lotes são processados em partes que cabem nele
+MAX_REQUEST_PIXELS = int(os.getenv('MAX_REQUEST_PIXELS', 50_000_000))
+
+def open_upload_image(stream, max_dimension=MAX_IMAGE_DIMENSION, max_size=None, max_pixels=MAX_REQUEST_PIXELS):
+    """Lê o cabeçalho de uma imagem enviada e valida formato, dimensões e número de pixels.
+    
+    Nenhum pixel é decodificado. Com max_size, JPEGs maiores são preparados para decodificar
+    já reduzidos no domínio DCT (draft), e o orçamento de pixels vale para o tamanho reduzido.
+    """
+    with timed_stage('validate'):
+        try:
+            # Image.open é preguiçoso: lê apenas o cabeçalho
+            image = Image.open(stream)
+        except Exception:
+            raise InvalidImageError("Arquivo não é uma imagem válida")
+        
+        if not image.format:
+            raise InvalidImageError("Arquivo não é uma imagem válida")
+        
+        IMAGE_MEGAPIXELS.observe(image.width * image.height / 1e6)
+        if image.width > max_dimension or image.height > max_dimension:
+            raise OversizedImageError(f"Imagem muito grande. Dimensão máxima permitida: {max_dimension}px")
+        
+        if max_size and (image.width > max_size or image.height > max_size):
+            # Para JPEG, escolhe a menor escala de decodificação (1/2, 1/4, 1/8) que ainda cobre max_size
+            image.draft('RGB', (max_size, max_size))
+        
+        if max_pixels and image.width * image.height > max_pixels:
+            raise OversizedImageError(f"Imagem muito grande. Máximo permitido: {max_pixels / 1e6:g} megapixels")
+    return image
+
+def decode_upload_image(image, max_size=None):
+    """Decodifica uma imagem aberta por open_upload_image, reduzida para max_size se pedido"""
+    with timed_stage('decode'):
+        try:
+            image.load()
+        except Exception:
+            raise InvalidImageError("Arquivo não é uma imagem válida")
+    
+    if max_size:
+        with timed_stage('resize'):
+            image.thumbnail((max_size, max_size), Image.LANCZOS)
+    return image
+
+def load_upload_image(stream, max_dimension=MAX_IMAGE_DIMENSION, max_size=None):
+    """Valida e decodifica uma imagem enviada, uma única vez.
+    
+    Apenas o cabeçalho é lido antes das verificações de formato, dimensões e pixels, de modo
+    que arquivos inválidos ou grandes demais são rejeitados sem decodificar os pixels.
+    Com max_size, JPEGs maiores são decodificados já reduzidos no domínio DCT (draft)
+    e a imagem é entregue com no máximo max_size pixels no maior lado.
+    """
+    return decode_upload_image(open_upload_image(stream, max_dimension, max_size), max_size)
+
+# Imagens remotas: /remove-background e /batch-remove aceitam URLs (url, urls ou um manifesto
+# JSON/CSV em manifest), baixadas por um pool de conexões HTTP. Só hosts da lista são aceitos
+REMOTE_URL_ALLOWED_HOSTS = [host.strip().lower() for host in os.getenv('REMOTE_URL_ALLOWED_HOSTS', '').split(',') if host.strip()]
+REMOTE_URL_ALLOW_PRIVATE = os.getenv('REMOTE_URL_ALLOW_PRIVATE', 'False').lower() in ('true', '1')  # Apenas para testes locais
+REMOTE_FETCH_TIMEOUT = float(os.getenv('REMOTE_FETCH_TIMEOUT', '10'))
+REMOTE_FETCH_MAX_BYTES = int(os.getenv('REMOTE_FETCH_MAX_BYTES', app.config['MAX_CONTENT_LENGTH']))
+REMOTE_FETCH_WORKERS = int(os.getenv('REMOTE_FETCH_WORKERS', '8'))
+REMOTE_FETCH_MAX_REDIRECTS = 3
+REMOTE_SPOOL_BYTES = 1024 * 1024  # Acima disso o conteúdo baixado vai para um arquivo temporário
+
+# Rotas que aceitam URLs remotas
+REMOTE_URL_ENDPOINTS = ('remove_background', 'batch_remove_background')
+
+# Extensão do arquivo baixado quando a URL não termina em uma extensão de imagem
+REMOTE_CONTENT_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/bmp': '.bmp',
+    'image/webp': '.webp',
+}
+
+class RemoteURLError(ValueError):
+    """Erro nas URLs remotas de uma requisição (desativadas, em excesso ou manifesto inválido)"""
+
+class RemoteFetchError(Exception):
+    """Falha ao baixar uma URL remota; filename identifica a URL (sem a query) nas respostas"""
+
+    def __init__(self, message, filename):
+        super().__init__(message)
+        self.filename = filename
+
+class RemoteImageFetcher:
+    """Baixa imagens remotas em paralelo, com um pool de conexões HTTP por processo.
+    
+    Cada URL precisa usar http ou https e apontar para um host de allowed_hosts
+    ('exemplo.com', '.exemplo.com' para subdomínios ou '*' para todos). Os endereços do host
+    são resolvidos e recusados se não forem públicos, a não ser com allow_private.
+    Redirecionamentos são seguidos manualmente e validados da mesma forma. O download é
+    interrompido acima de max_bytes ou de timeout segundos.
+    """
+
+    def __init__(self, allowed_hosts, allow_private, timeout, max_bytes, max_workers):
+        self.allowed_hosts = allowed_hosts
+        self.allow_private = allow_private
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_workers = max(max_workers, 1)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.allowed_hosts)
+
+    def fetch_all(self, urls):
+        """Baixa as URLs em paralelo; retorna, na mesma ordem, um FileStorage ou a RemoteFetchError de cada uma"""
+        self._ensure_pools()
+        with timed_stage('fetch'):
+            return list(self._executor.map(self._fetch_or_error, urls))
+
+    def _ensure_pools(self):
+        # Conexões e threads não sobrevivem ao fork: criar os pools uma vez por processo
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='remote-fetch')
+                    self._pid = os.getpid()
+
+    def _fetch_or_error(self, url):
+        try:
+            return self.fetch(url)
+        except RemoteFetchError as e:
+            return e
+
+    def fetch(self, url):
+        """Baixa uma URL e a devolve como um FileStorage, como um arquivo enviado"""
+        self._ensure_pools()
+        name = self.display_name(url)
+        deadline = time.monotonic() + self.timeout
+        for _ in range(REMOTE_FETCH_MAX_REDIRECTS + 1):
+            self.check_url(url, name)
+            try:
+                response = self._session.get(url, stream=True, allow_redirects=False, timeout=self.timeout)
+            except requests.RequestException as e:
+                raise RemoteFetchError(f"Não foi possível baixar a imagem: {type(e).__name__}", name)
+            
+            with response:
+                if response.is_redirect:
+                    url = urljoin(url, response.headers['Location'])
+                    continue
+                if response.status_code != 200:
+                    raise RemoteFetchError(f"Não foi possível baixar a imagem: HTTP {response.status_code}", name)
+                return self._read(response, name, deadline)
+        raise RemoteFetchError("Não foi possível baixar a imagem: redirecionamentos demais", name)
+
+    def _read(self, response, name, deadline):
+        if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+            raise RemoteFetchError(f"Imagem remota muito grande. Tamanho máximo: {self.max_bytes} bytes", name)
         
-        # Processar a imagem redimensionada
-        output_image = remove(resized_image)
+        # O tamanho é conferido durante o download: Content-Length pode estar ausente ou errado
+        stream = tempfile.SpooledTemporaryFile(max_size=REMOTE_SPOOL_BYTES)
+        size = 0
+        try:
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.max_bytes:
+                    raise RemoteFetchError(f"Imagem remota muito grande. Tamanho máximo: {self.max_bytes} bytes", name)
+                if time.monotonic() > deadline:
+                    raise RemoteFetchError("Não foi possível baixar a imagem: tempo esgotado", name)
+                stream.write(chunk)
+        except requests.RequestException as e:
+            stream.close()
+            raise RemoteFetchError(f"Não foi possível baixar a imagem: {type(e).__name__}", name)
+        except RemoteFetchError:
+            stream.close()
+            raise
+        stream.seek(0)
         
-        # Liberar memória da imagem redimensionada
-        del resized_image
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if os.path.splitext(name)[1].lower() not in app.config['UPLOAD_EXTENSIONS']:
+            name += REMOTE_CONTENT_EXTENSIONS.get(content_type, '')
+        return FileStorage(stream=stream, filename=name, content_type=content_type)
+
+    def check_url(self, url, name):
+        """Recusa URLs fora da lista de hosts permitidos ou que apontem para endereços internos"""
+        parsed = urlparse(url)
+        host = (parsed.hostname or '').lower()
+        if parsed.scheme not in ('http', 'https') or not host:
+            raise RemoteFetchError("URL inválida: use http ou https", name)
+        if not self.host_allowed(host):
+            raise RemoteFetchError(f"Host não permitido: {host}", name)
+        if self.allow_private:
+            return
         
-        # Redimensionar de volta para o tamanho original
-        if orig_width != new_width or orig_height != new_height:
-            output_image = output_image.resize((orig_width, orig_height), Image.LANCZOS)
-    else:
-        # Processar a imagem original
-        output_image = remove(input_image)
+        try:
+            addresses = {info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)}
+        except (socket.gaierror, UnicodeError):
+            raise RemoteFetchError(f"Não foi possível resolver o host: {host}", name)
+        for address in addresses:
+            ip = ipaddress.ip_address(address.split('%')[0])
+            if getattr(ip, 'ipv4_mapped', None):
+                ip = ip.ipv4_mapped
+            if not ip.is_global:
+                raise RemoteFetchError(f"Host não permitido: {host}", name)
+
+    def host_allowed(self, host):
+        """Indica se o host está na lista: nome exato, '.dominio' ou '*.dominio' para subdomínios, ou '*'"""
+        for allowed in self.allowed_hosts:
+            domain = allowed.lstrip('*.')
+            if allowed == '*' or host == domain or (allowed != domain and host.endswith('.' + domain)):
+                return True
+        return False
+
+    @staticmethod
+    def display_name(url):
+        """Nome da URL nas respostas e nos logs: sem a query, que pode conter assinaturas"""
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc.rpartition('@')[2]}{parsed.path}"
+
+remote_fetcher = RemoteImageFetcher(
+    REMOTE_URL_ALLOWED_HOSTS, REMOTE_URL_ALLOW_PRIVATE, REMOTE_FETCH_TIMEOUT, REMOTE_FETCH_MAX_BYTES, REMOTE_FETCH_WORKERS
+)
+
+def parse_url_manifest(data):
+    """Lê as URLs de um manifesto JSON (lista de URLs ou de objetos com url, ou {"urls": [...]})
+    ou CSV (coluna url, ou a primeira coluna sem cabeçalho)"""
+    try:
+        text = data.decode('utf-8-sig').strip()
+    except UnicodeDecodeError:
+        raise RemoteURLError("Manifesto inválido: use JSON ou CSV em UTF-8")
     
-    # Forçar coleta de lixo para liberar memória
-    import gc
-    gc.collect()
+    if text[:1] in ('[', '{'):
+        try:
+            entries = json.loads(text)
+        except ValueError:
+            raise RemoteURLError("Manifesto JSON inválido")
+        if isinstance(entries, dict):
+            entries = entries.get('urls')
+        if not isinstance(entries, list):
+            raise RemoteURLError("Manifesto JSON inválido: informe uma lista de URLs")
+        urls = [entry.get('url') if isinstance(entry, dict) else entry for entry in entries]
+        if not all(isinstance(url, str) for url in urls):
+            raise RemoteURLError("Manifesto JSON inválido: cada item precisa de uma URL")
+        return [url.strip() for url in urls]
     
-    return output_image
+    rows = [row for row in csv.reader(io.StringIO(text)) if row and row[0].strip()]
+    header = [column.strip().lower() for column in rows[0]] if rows else []
+    if 'url' in header:
+        column = header.index('url')
+        return [row[column].strip() for row in rows[1:] if len(row) > column and row[column].strip()]
+    return [row[0].strip() for row in rows]
 
-# Configuração de logs de segurança
-LOG_FOLDER = 'logs'
-os.makedirs(LOG_FOLDER, exist_ok=True)
+def requested_urls():
+    """URLs remotas pedidas na requisição: campos url e urls e o arquivo de manifesto"""
+    urls = request.values.getlist('url') + request.values.getlist('urls')
+    manifest = request.files.get('manifest')
+    if manifest and manifest.filename:
+        urls += parse_url_manifest(manifest.stream.read())
+    return [url for url in urls if url]
 
-# Configurar logger principal
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+def check_remote_url_count(count):
+    """Recusa, antes de qualquer download, mais URLs do que a rota e o modo da requisição aceitam"""
+    if request.endpoint == 'remove_background':
+        if count > 1:
+            raise RemoteURLError("Informe apenas uma URL; para várias imagens use /batch-remove")
+        if 'file' in request.files:
+            raise RemoteURLError("Informe file ou url, não ambos")
+        return
+    
+    # Em /batch-remove as URLs somam-se aos arquivos enviados no limite do modo pedido
+    max_files = BATCH_MAX_FILES_ASYNC if batch_async_mode() else BATCH_MAX_FILES
+    total = count + sum(1 for file in request.files.getlist('files') if file.filename)
+    if total > max_files:
+        log_security_event('BATCH_LIMIT_EXCEEDED', f'Tentativa de processamento em lote com {total} arquivos')
+        raise RemoteURLError(f"Número máximo de arquivos por requisição: {max_files}")
 
-# Adicionar handler para arquivo com rotação
-handler = RotatingFileHandler(
-    os.path.join(LOG_FOLDER, 'app.log'),
-    maxBytes=10485760,  # 10MB
-    backupCount=10
-)
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-handler.setLevel(logging.INFO)
-logger.addHandler(handler)
+def remote_uploads():
+    """Imagens remotas da requisição, baixadas uma única vez (FileStorage ou RemoteFetchError).
+    
+    Levanta RemoteURLError se as URLs não puderem ser aceitas.
+    """
+    if 'remote_uploads' not in g:
+        try:
+            urls = requested_urls()
+            if urls:
+                if not remote_fetcher.enabled:
+                    raise RemoteURLError("URLs remotas não estão habilitadas neste servidor")
+                check_remote_url_count(len(urls))
+            g.remote_uploads = remote_fetcher.fetch_all(urls) if urls else []
+        except RemoteURLError as e:
+            g.remote_uploads = e
+    if isinstance(g.remote_uploads, RemoteURLError):
+        raise g.remote_uploads
+    return g.remote_uploads
 
-# Logger específico para eventos de segurança
-security_logger = logging.getLogger('security')
-security_logger.setLevel(logging.INFO)
-security_handler = RotatingFileHandler(
-    os.path.join(LOG_FOLDER, 'security.log'),
-    maxBytes=10485760,
-    backupCount=10
-)
-security_handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [ip: %(remote_addr)s]'
-))
-security_logger.addHandler(security_handler)
+@app.teardown_request
+def close_remote_uploads(exc):
+    """Fecha os arquivos temporários das imagens remotas ao final da requisição"""
+    uploads = g.pop('remote_uploads', None)
+    if isinstance(uploads, list):
+        for file in uploads:
+            if isinstance(file, FileStorage):
+                file.close()
 
-# Carregar configurações de um arquivo .env
-from dotenv import load_dotenv
-load_dotenv()
+# Formatos de saída: nome do formato no Pillow, tipo MIME e extensão do arquivo
+OUTPUT_FORMATS = {
+    'png': ('PNG', 'image/png', '.png'),
+    'webp': ('WEBP', 'image/webp', '.webp'),
+    'avif': ('AVIF', 'image/avif', '.avif'),
+}
+DEFAULT_OUTPUT_FORMAT = os.getenv('OUTPUT_FORMAT', 'png').lower()
+DEFAULT_OUTPUT_QUALITY = int(os.getenv('OUTPUT_QUALITY', '90'))  # WebP e AVIF
+DEFAULT_PNG_COMPRESS_LEVEL = int(os.getenv('PNG_COMPRESS_LEVEL', '6'))
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', secrets.token_hex(32))
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limitar uploads a 16MB
-app.config['UPLOAD_EXTENSIONS'] = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
-app.config['API_KEYS'] = os.getenv('API_KEYS', '').split(',')
+# O plugin registra o AVIF no Pillow ao ser importado: na carga do módulo, para que qualquer
+# worker consiga ler resultados .avif gravados por outro
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pillow_avif = None
 
-# Aplicar ProxyFix para garantir que os endereços IP corretos sejam registrados
-app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
+def avif_supported():
+    """Verifica se o Pillow consegue gravar AVIF (nativamente ou via pillow-avif-plugin)"""
+    return 'AVIF' in Image.SAVE
 
-# Configurar limitador de taxa
-limiter = Limiter(
-    app=app,
-    key_func=get_remote_address,
-    default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",
-)
+def encode_image(image, params):
+    """Codifica a imagem de saída no formato pedido e retorna os bytes"""
+    pil_format = OUTPUT_FORMATS[params['format']][0]
+    buffer = io.BytesIO()
+    with timed_stage('encode'):
+        if pil_format == 'PNG':
+            # Sem optimize: a compressão extra custa muito mais CPU do que economiza em bytes
+            image.save(buffer, format='PNG', compress_level=params['compress_level'])
+        elif pil_format == 'WEBP':
+            image.save(buffer, format='WEBP', quality=params['quality'], lossless=params['quality'] == 100, method=4)
+        else:
+            image.save(buffer, format=pil_format, quality=params['quality'])
+    return buffer.getvalue()
 
-# Pasta para armazenar imagens processadas
-UPLOAD_FOLDER = 'uploads'
-PROCESSED_FOLDER = 'processed'
+# Tipos de resultado (output=): imagem recortada, máscara em um canal ou máscara RLE em JSON
+OUTPUT_TYPES = ('image', 'mask', 'rle')
+RLE_MIMETYPE = 'application/json'
+RLE_EXTENSION = '.json'
 
-# Criar pastas se não existirem
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(PROCESSED_FOLDER, exist_ok=True)
+def output_media_type(params):
+    """Tipo MIME e extensão do arquivo de resultado de acordo com output e format"""
+    if params.get('output') == 'rle':
+        return RLE_MIMETYPE, RLE_EXTENSION
+    return OUTPUT_FORMATS[params['format']][1:]
+
+def encode_output(image, params):
+    """Codifica o resultado pedido a partir da imagem recortada (RGBA) ou da máscara (L)"""
+    output = params.get('output', 'image')
+    if output == 'image':
+        return encode_image(image, params)
+    
+    mask = image.getchannel('A') if image.mode == 'RGBA' else image
+    if output == 'rle':
+        return encode_mask_rle(mask)
+    return encode_image(mask, params)
+
+def encode_mask_rle(mask):
+    """Codifica a máscara por comprimento de sequências (RLE), em JSON.
+    
+    Os pixels são percorridos linha a linha: values[i] se repete counts[i] vezes.
+    """
+    with timed_stage('encode'):
+        flat = np.asarray(mask, dtype=np.uint8).ravel()
+        starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        counts = np.diff(np.append(starts, flat.size))
+        data = {
+            'width': mask.width,
+            'height': mask.height,
+            'values': flat[starts].tolist(),
+            'counts': counts.tolist(),
+        }
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def decode_mask_rle(data, max_dimension=MAX_IMAGE_DIMENSION):
+    """Reconstrói a máscara (modo L) a partir do JSON gerado por encode_mask_rle"""
+    try:
+        rle = json.loads(data)
+        width, height = int(rle['width']), int(rle['height'])
+        values = np.array(rle['values'], dtype=np.int64)
+        counts = np.array(rle['counts'], dtype=np.int64)
+    except (ValueError, TypeError, KeyError):
+        raise InvalidImageError("Máscara RLE inválida")
+    
+    if not (0 < width <= max_dimension and 0 < height <= max_dimension):
+        raise OversizedImageError(f"Máscara muito grande. Dimensão máxima permitida: {max_dimension}px")
+    if (values.shape != counts.shape or values.ndim != 1 or counts.min(initial=0) < 0
+            or values.min(initial=0) < 0 or values.max(initial=0) > 255 or counts.sum() != width * height):
+        raise InvalidImageError("Máscara RLE inválida")
+    return Image.fromarray(np.repeat(values.astype(np.uint8), counts).reshape(height, width), mode='L')
+
+def write_output_file(path, data):
+    """Grava os bytes de um resultado em disco"""
+    with timed_stage('disk_write'):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+def find_output_file(file_id):
+    """Localiza o arquivo processado de um ID pelo índice do armazenamento.
+    
+    Retorna (caminho, formato); máscaras RLE são identificadas pelo formato 'rle'.
+    """
+    record = result_storage.lookup(file_id)
+    return (record['path'], record['format']) if record else (None, None)
+
+def send_stored_result(record, download_name, cache_control):
+    """Envia um resultado armazenado com ETag forte (hash do conteúdo), 304 e suporte a Range.
+    
+    Com X_ACCEL_REDIRECT_PREFIX o nginx envia o arquivo; com USE_X_SENDFILE, o servidor
+    compatível com X-Sendfile. Sem eles, o Gunicorn envia o arquivo com sendfile(), sem
+    copiar os bytes pelo Python (exceto em respostas parciais).
+    """
+    mimetype = RLE_MIMETYPE if record['format'] == 'rle' else OUTPUT_FORMATS[record['format']][1]
+    
+    if request.if_none_match.contains(record['content_hash']):
+        response = make_response('', 304)
+    elif X_ACCEL_REDIRECT_PREFIX:
+        # O nginx lê o arquivo da location interna e trata Range por conta própria
+        relative_path = os.path.relpath(record['path'], PROCESSED_FOLDER).replace(os.sep, '/')
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_path}"
+        response.headers['Content-Type'] = mimetype
+        response.headers['Content-Disposition'] = f'attachment; filename="{download_name}"'
+    else:
+        response = send_file(
+            record['path'],
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=download_name,
+            etag=record['content_hash'],
+            conditional=True
+        )
+        response.accept_ranges = 'bytes'
+    
+    response.set_etag(record['content_hash'])
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def result_url(content_hash, stored_format):
+    """URL imutável de um resultado, derivada do hash do conteúdo"""
+    ext = RLE_EXTENSION if stored_format == 'rle' else OUTPUT_FORMATS[stored_format][2]
+    return url_for('get_result', name=f"{content_hash}{ext}")
+
+def output_format(params):
+    """Nome do formato do resultado no armazenamento: o formato de imagem ou 'rle'"""
+    return 'rle' if params.get('output') == 'rle' else params['format']
 
 # Funções auxiliares de segurança
 def validate_image(stream):
@@ -197,12 +2794,77 @@ def log_security_event(event_type, details, level=logging.INFO):
         'timestamp': datetime.utcnow().isoformat()
     }
     security_logger.log(level, f"{event_type}: {details}", extra=extra)
+    SECURITY_EVENTS_TOTAL.labels(event_type=event_type).inc()
+
+def get_processing_params():
+    """Lê da requisição os parâmetros opcionais de processamento e de codificação da saída.
+    
+    Retorna um dicionário usado no processamento, na chave do cache e nos jobs assíncronos.
+    """
+    params = {
+        'max_size': None,
+        'format': request.values.get('format', DEFAULT_OUTPUT_FORMAT).lower(),
+        'quality': DEFAULT_OUTPUT_QUALITY,
+        'compress_level': DEFAULT_PNG_COMPRESS_LEVEL,
+        'model': rembg_sessions.model_name,
+        'output': request.values.get('output', 'image').lower(),
+    }
+    
+    if params['output'] not in OUTPUT_TYPES:
+        raise ValueError(f"Parâmetro output inválido. Valores aceitos: {', '.join(OUTPUT_TYPES)}")
+    
+    value = request.values.get('max_size', '')
+    if value:
+        try:
+            params['max_size'] = int(value)
+        except ValueError:
+            raise ValueError("Parâmetro max_size inválido")
+        if params['max_size'] < 1 or params['max_size'] > MAX_IMAGE_DIMENSION:
+            raise ValueError(f"Parâmetro max_size deve estar entre 1 e {MAX_IMAGE_DIMENSION}")
+    
+    if params['format'] not in OUTPUT_FORMATS:
+        raise ValueError(f"Formato de saída inválido. Formatos aceitos: {', '.join(OUTPUT_FORMATS)}")
+    if params['format'] == 'avif' and not avif_supported():
+        raise ValueError("Formato AVIF não disponível neste servidor")
+    
+    # quality aceita um nível (fast, balanced, best), que escolhe o modelo, ou um número para WebP/AVIF
+    model = request.values.get('model', '').strip()
+    tier = request.values.get('quality', '').strip().lower()
+    if tier in QUALITY_TIERS:
+        if model:
+            raise ValueError("Informe o parâmetro model ou um nível de quality, não os dois")
+        params['model'] = QUALITY_TIERS[tier]
+    elif model:
+        if model not in ALLOWED_MODELS:
+            raise ValueError(f"Modelo inválido. Modelos aceitos: {', '.join(ALLOWED_MODELS)}")
+        params['model'] = model
+    
+    for name, minimum, maximum in (('quality', 1, 100), ('compress_level', 0, 9)):
+        value = request.values.get(name, '')
+        if value and not (name == 'quality' and tier in QUALITY_TIERS):
+            try:
+                params[name] = int(value)
+            except ValueError:
+                if name == 'quality':
+                    raise ValueError(f"Parâmetro quality inválido. Use um número de 1 a 100 ou um nível: {', '.join(QUALITY_TIERS)}")
+                raise ValueError(f"Parâmetro {name} inválido")
+            if params[name] < minimum or params[name] > maximum:
+                raise ValueError(f"Parâmetro {name} deve estar entre {minimum} e {maximum}")
+    
+    # Parâmetros que não afetam o formato escolhido não devem separar entradas do cache
+    if params['output'] == 'rle':
+        params['format'] = params['quality'] = params['compress_level'] = None
+    elif params['format'] == 'png':
+        params['quality'] = None
+    else:
+        params['compress_level'] = None
+    return params
 
 def require_api_key(view_function):
     """Decorador para exigir API key para endpoints sensíveis"""
     @functools.wraps(view_function)
     def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('X-API-Key', '') or request.args.get('api_key', '')
+        api_key = request_api_key()
         
         # Permitir acesso à interface web sem API key
         if request.path == '/' and request.method == 'GET':
@@ -219,6 +2881,40 @@ def require_api_key(view_function):
         return view_function(*args, **kwargs)
     return decorated_function
 
+# Medição das etapas de cada requisição, devolvida no cabeçalho Server-Timing
+@app.before_request
+def reset_stage_timings():
+    start_stage_timings()
+
+@app.before_request
+def reject_when_busy():
+    """Recusa novos envios antes de receber o corpo quando a fila de processamento está cheia"""
+    if request.endpoint == 'remove_background' and inference_executor.is_full():
+        raise InferenceQueueFull()
+
+@app.after_request
+def record_request_metrics(response):
+    """Contabiliza a requisição por rota e status e o tamanho do corpo recebido"""
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    REQUESTS_TOTAL.labels(endpoint=endpoint, method=request.method, status=response.status_code).inc()
+    if request.content_length:
+        REQUEST_SIZE_BYTES.labels(endpoint=endpoint).observe(request.content_length)
+    peak_memory = getattr(_stage_timings, 'peak_memory', None)
+    if peak_memory is not None:
+        REQUEST_PEAK_MEMORY_BYTES.labels(endpoint=endpoint).observe(peak_memory)
+        response.headers['X-Peak-Memory'] = str(peak_memory)
+    return response
+
+@app.after_request
+def add_server_timing(response):
+    """Adiciona o tempo de cada etapa do processamento ao cabeçalho Server-Timing"""
+    timings = get_stage_timings()
+    if timings:
+        response.headers['Server-Timing'] = ', '.join(
+            f"{name};dur={duration * 1000:.1f}" for name, duration in timings.items()
+        )
+    return response
+
 # Middleware para adicionar cabeçalhos de segurança a todas as respostas
 @app.after_request
 def add_security_headers(response):
@@ -229,8 +2925,10 @@ def add_security_headers(response):
     response.headers['Strict-Transport-Security'] = 'max-age=31536000; includeSubDomains'
     response.headers['Content-Security-Policy'] = "default-src 'self'; img-src 'self' data:; style-src 'self' 'unsafe-inline'; script-src 'self' 'unsafe-inline'"
     response.headers['Referrer-Policy'] = 'same-origin'
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
+    # Os resultados armazenados definem o próprio Cache-Control; as demais respostas não vão para cache
+    if request.endpoint not in RESULT_ENDPOINTS or 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+        response.headers['Pragma'] = 'no-cache'
     return response
 
 @app.route('/')
@@ -239,28 +2937,70 @@ def index():
     return render_template('index.html')
 
 @app.route('/health', methods=['GET'])
+@limiter.exempt
 def health_check():
     """Endpoint para verificar se a API está funcionando"""
-    return jsonify({"status": "ok"}), 200
+    return jsonify({"status": "ok", "model": rembg_sessions.status()}), 200
+
+@app.route('/ready', methods=['GET'])
+@limiter.exempt
+def readiness_check():
+    """Indica se o processo pode receber tráfego: modelo padrão carregado e aquecido"""
+    model = rembg_sessions.status()
+    ready = model["loaded"]
+    return jsonify({
+        "status": "ready" if ready else "starting",
+        "model": model,
+        "startup": startup_timings,
+    }), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def metrics():
+    """Endpoint com as métricas no formato do Prometheus, agregadas entre os processos"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    response = make_response(generate_latest(registry))
+    response.headers['Content-Type'] = CONTENT_TYPE_LATEST
+    return response
 
 @app.route('/remove-background', methods=['POST'])
 @require_api_key
 @limiter.limit("20 per minute")  # Reduzido de 30 para 20
+@megapixel_limit
 def remove_background():
     """
     Remove o fundo de uma imagem enviada via POST.
     
     Parâmetros esperados:
-    - file: arquivo de imagem
+    - file: arquivo de imagem, ou url: URL da imagem em um host permitido
+    - max_size (opcional): dimensão máxima, em pixels, da imagem de saída
+    - format (opcional): png, webp ou avif
+    - quality (opcional): qualidade de 1 a 100 para WebP e AVIF
+    - compress_level (opcional): nível de compressão de 0 a 9 para PNG
     
     Retorna:
     - A imagem processada sem fundo
     """
-    if 'file' not in request.files:
+    # Imagem remota: baixada antes da rota, para a cota de megapixels
+    try:
+        remote_files = remote_uploads()
+    except RemoteURLError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if remote_files:
+        file = remote_files[0]
+        if isinstance(file, RemoteFetchError):
+            log_security_event('REMOTE_FETCH_FAILED', f'{file.filename}: {str(file)}')
+            return jsonify({"error": str(file)}), 400
+    elif 'file' not in request.files:
         logger.error("Nenhum arquivo encontrado na requisição")
         return jsonify({"error": "Nenhum arquivo encontrado"}), 400
-    
-    file = request.files['file']
+    else:
+        file = request.files['file']
     
     if file.filename == '':
         logger.error("Nome de arquivo vazio")
@@ -273,70 +3013,101 @@ def remove_background():
     if file_ext not in app.config['UPLOAD_EXTENSIONS']:
         log_security_event('INVALID_FILE', f'Extensão de arquivo não permitida: {file_ext}')
         return jsonify({"error": "Formato de arquivo não permitido"}), 400
-        
-    # Verificar o conteúdo do arquivo para garantir que é realmente uma imagem
-    if not validate_image(file.stream):
-        log_security_event('INVALID_FILE', 'Arquivo não é uma imagem válida')
-        return jsonify({"error": "Arquivo não é uma imagem válida"}), 400
     
     try:
-        # Ler a imagem de entrada
-        input_image = Image.open(file.stream)
+        params = get_processing_params()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    require_model(params['model'])
+    mimetype, output_ext = output_media_type(params)
+    
+    # Consultar o cache antes de decodificar: o mesmo conteúdo com os mesmos parâmetros gera o mesmo resultado
+    input_data = file.stream.read()
+    file.stream.seek(0)
+    cache_key = ResultCache.make_key(input_data, **params)
+    cached_output = result_cache.get(cache_key)
+    if cached_output is not None:
+        file_id = str(uuid.uuid4())
+        _, content_hash = result_storage.save(file_id, cached_output, output_format(params))
         
-        # Limitar o tamanho da imagem para processamento
-        max_dimension = 2500  # Reduzido de 3000 para 2500 pixels
-        if input_image.width > max_dimension or input_image.height > max_dimension:
-            log_security_event('OVERSIZED_IMAGE', f'Imagem muito grande: {input_image.width}x{input_image.height}')
-            return jsonify({"error": f"Imagem muito grande. Dimensão máxima permitida: {max_dimension}px"}), 400
+        logger.info(f"Imagem servida do cache: {file_id}")
         
+        response = make_response(send_file(
+            io.BytesIO(cached_output),
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=f"no_bg_{file_id}{output_ext}"
+        ))
+        response.headers['X-Request-ID'] = file_id
+        response.headers['X-Cache'] = 'HIT'
+        response.headers['X-Model'] = params['model']
+        response.headers['X-Result-URL'] = result_url(content_hash, output_format(params))
+        response.set_etag(cache_key)
+        return response
+    
+    # Validar e decodificar a imagem uma única vez; o mesmo objeto segue para a inferência
+    try:
+        input_image = load_upload_image(file.stream, max_size=params['max_size'])
+    except OversizedImageError as e:
+        log_security_event('OVERSIZED_IMAGE', f'Imagem muito grande: {file.filename}')
+        return jsonify({"error": str(e)}), 400
+    except InvalidImageError as e:
+        log_security_event('INVALID_FILE', 'Arquivo não é uma imagem válida')
+        return jsonify({"error": str(e)}), 400
+    
+    try:
         # Gerar um ID único para o arquivo
         file_id = str(uuid.uuid4())
         
         # Registrar a operação
         logger.info(f"Processando imagem {file_id} - IP: {get_remote_address()}")
         
-        # Processar a imagem para remover o fundo
+        # Uma imagem quase idêntica a outra já processada reaproveita a máscara, sem executar o modelo
+        near_key = near_duplicates.image_key(input_image) if near_duplicates.enabled else None
+        near_mask = near_duplicates.find(near_key, params['model']) if near_key else None
+        if near_mask is not None:
+            CACHE_LOOKUPS_TOTAL.labels(result='near_hit').inc()
+        
+        # Processar a imagem para remover o fundo no executor de CPU
         start_time = time.time()
-        output_image = process_image_remove_bg(input_image)
+        output_data, mask = inference_executor.run(render_output, input_image, params, near_mask)
         processing_time = time.time() - start_time
         
         # Limpar a memória da imagem de entrada que não é mais necessária
         del input_image
         
-        # Preparar o buffer para enviar a imagem de volta
-        img_byte_arr = io.BytesIO()
-        output_image.save(img_byte_arr, format='PNG', optimize=True)
-        img_byte_arr.seek(0)
-        
-        # Salvar as imagens (opcional)
-        input_path = os.path.join(UPLOAD_FOLDER, f"{file_id}_input.png")
-        output_path = os.path.join(PROCESSED_FOLDER, f"{file_id}_output.png")
+        result_cache.put(cache_key, output_data)
+        if near_key and near_mask is None:
+            try:
+                near_duplicates.add(near_key, params['model'], mask)
+            except (OSError, sqlite3.Error) as e:
+                logger.error(f"Erro ao registrar máscara no índice de imagens semelhantes: {str(e)}")
+        del mask
         
         # Salvar a imagem de saída
-        output_image.save(output_path, optimize=True)
-        
-        # Limpar a memória da imagem de saída
-        del output_image
-        
-        # Forçar a coleta de lixo para liberar memória
-        import gc
-        gc.collect()
+        _, content_hash = result_storage.save(file_id, output_data, output_format(params))
         
         logger.info(f"Imagem processada com sucesso: {file_id} em {processing_time:.2f}s")
         
         # Retornar a imagem sem fundo
         response = make_response(send_file(
-            img_byte_arr,
-            mimetype='image/png',
+            io.BytesIO(output_data),
+            mimetype=mimetype,
             as_attachment=True,
-            download_name=f"no_bg_{file_id}.png"
+            download_name=f"no_bg_{file_id}{output_ext}"
         ))
         
         # Adicionar identificadores únicos no cabeçalho da resposta para rastreamento
         response.headers['X-Request-ID'] = file_id
+        response.headers['X-Cache'] = 'MISS' if near_mask is None else 'NEAR-HIT'
+        response.headers['X-Model'] = params['model']
+        response.headers['X-Result-URL'] = result_url(content_hash, output_format(params))
+        response.set_etag(cache_key)
         
         return response
         
+    except InferenceQueueFull:
+        raise
     except Exception as e:
         logger.error(f"Erro ao processar imagem: {str(e)}")
         return jsonify({"error": f"Erro ao processar imagem: {str(e)}"}), 500
@@ -344,37 +3115,80 @@ def remove_background():
 @app.route('/batch-remove', methods=['POST'])
 @require_api_key
 @limiter.limit("5 per minute")  # Reduzido para 5 por minuto
+@megapixel_limit
 def batch_remove_background():
     """
     Remove o fundo de múltiplas imagens enviadas via POST.
     
     Parâmetros esperados:
     - files: arquivos de imagem (múltiplos)
+    - urls, manifest (opcionais): URLs de imagens em hosts permitidos, repetidas em urls ou em
+      um arquivo de manifesto JSON ou CSV; são processadas depois dos arquivos enviados
+    - async: se verdadeiro, enfileira o lote e retorna imediatamente o ID do job
+    - stream (opcional): ndjson, multipart ou zip para receber os resultados na própria resposta
+    - max_size (opcional): dimensão máxima, em pixels, das imagens de saída
+    - format, quality, compress_level (opcionais): formato e compressão das imagens de saída
     
     Retorna:
     - IDs das imagens processadas para download posterior
+    - No modo assíncrono, o ID do job para consulta em /jobs/<job_id>
     """
-    if 'files' not in request.files:
+    # Imagens remotas: baixadas antes da rota, para a cota de megapixels
+    try:
+        remote_files = remote_uploads()
+    except RemoteURLError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    if 'files' not in request.files and not remote_files:
         logger.error("Nenhum arquivo encontrado na requisição")
         return jsonify({"error": "Nenhum arquivo encontrado"}), 400
     
-    files = request.files.getlist('files')
+    files = [file for file in request.files.getlist('files') if file.filename] + remote_files
     
-    if not files or files[0].filename == '':
+    if not files:
         logger.error("Nenhum arquivo selecionado")
         return jsonify({"error": "Nenhum arquivo selecionado"}), 400
     
+    # Modo assíncrono: os arquivos são enfileirados e processados pelos workers de jobs
+    async_mode = batch_async_mode()
+    
+    # Modo streaming: os resultados são enviados na resposta à medida que ficam prontos
+    stream_format = request.values.get('stream', '').lower()
+    if stream_format and stream_format not in BATCH_STREAM_FORMATS:
+        return jsonify({"error": f"Parâmetro stream inválido. Use: {', '.join(BATCH_STREAM_FORMATS)}"}), 400
+    if stream_format and async_mode:
+        return jsonify({"error": "Os parâmetros async e stream não podem ser usados juntos"}), 400
+    
     # Limitar o número de arquivos por requisição
-    max_files = 5  # Reduzido de 10 para 5
+    max_files = BATCH_MAX_FILES_ASYNC if async_mode else BATCH_MAX_FILES
     if len(files) > max_files:
         log_security_event('BATCH_LIMIT_EXCEEDED', f'Tentativa de processamento em lote com {len(files)} arquivos')
         return jsonify({"error": f"Número máximo de arquivos por requisição: {max_files}"}), 400
     
+    try:
+        params = get_processing_params()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    require_model(params['model'])
+    
+    if async_mode:
+        return submit_batch_job(files, params)
+    if stream_format:
+        return stream_batch_results(files, params, stream_format)
+    
     processed_files = []
     failed_files = []
+    valid_files = []
     
     try:
         for file in files:
+            if isinstance(file, RemoteFetchError):
+                failed_files.append({
+                    "original_name": file.filename,
+                    "error": str(file)
+                })
+                continue
+            
             # Validar o nome do arquivo
             filename = secure_filename(file.filename)
             file_ext = os.path.splitext(filename)[1].lower()
@@ -385,58 +3199,24 @@ def batch_remove_background():
                     "error": "Formato de arquivo não permitido"
                 })
                 continue
-                
-            # Verificar se é uma imagem válida
-            if not validate_image(file.stream):
+            
+            valid_files.append(file)
+        
+        results = inference_executor.run(process_batch_files, [file.stream for file in valid_files], params)
+        for file, result in zip(valid_files, results):
+            if isinstance(result, Exception):
                 failed_files.append({
                     "original_name": file.filename,
-                    "error": "Arquivo não é uma imagem válida"
+                    "error": str(result)
                 })
-                continue
-                
-            try:
-                # Ler a imagem de entrada
-                input_image = Image.open(file.stream)
-                
-                # Limitar o tamanho da imagem
-                max_dimension = 2500  # Reduzido de 3000 para 2500 pixels
-                if input_image.width > max_dimension or input_image.height > max_dimension:
-                    failed_files.append({
-                        "original_name": file.filename,
-                        "error": f"Imagem muito grande. Dimensão máxima permitida: {max_dimension}px"
-                    })
-                    continue
-                
-                # Gerar um ID único para o arquivo
-                file_id = str(uuid.uuid4())
-                
-                # Processar a imagem para remover o fundo
-                logger.info(f"Processando imagem em lote: {file_id}")
-                output_image = process_image_remove_bg(input_image)
-                
-                # Salvar as imagens
-                output_path = os.path.join(PROCESSED_FOLDER, f"{file_id}_output.png")
-                
-                # Salvar apenas a saída para economizar espaço
-                output_image.save(output_path, optimize=True)
-                
-                # Limpar memória
-                del input_image
-                del output_image
-                
+            else:
+                file_id, output_path, cached, content_hash = result
                 processed_files.append({
                     "file_id": file_id,
                     "original_name": file.filename,
-                    "output_path": output_path
-                })
-                
-                # Forçar coleta de lixo após cada processamento
-                import gc
-                gc.collect()
-            except Exception as e:
-                failed_files.append({
-                    "original_name": file.filename,
-                    "error": str(e)
+                    "output_path": output_path,
+                    "url": result_url(content_hash, output_format(params)),
+                    "cached": cached
                 })
         
         logger.info(f"Processamento em lote concluído: {len(processed_files)} imagens processadas, {len(failed_files)} falhas")
@@ -445,6 +3225,7 @@ def batch_remove_background():
         response_data = {
             "status": "success" if not failed_files else "partial_success", 
             "message": f"{len(processed_files)} imagens processadas, {len(failed_files)} falhas",
+            "model": params['model'],
             "files": processed_files
         }
         
@@ -453,10 +3234,377 @@ def batch_remove_background():
         
         return jsonify(response_data), 200
         
+    except InferenceQueueFull:
+        raise
     except Exception as e:
         logger.error(f"Erro ao processar imagens em lote: {str(e)}")
         return jsonify({"error": f"Erro ao processar imagens: {str(e)}"}), 500
 
+# Formatos da resposta em streaming de /batch-remove
+BATCH_STREAM_FORMATS = ('ndjson', 'multipart', 'zip')
+
+def batch_async_mode():
+    """Indica se o lote pede o modo assíncrono (async=true)"""
+    return request.values.get('async', '').lower() in ('1', 'true', 'yes')
+
+def stream_batch_results(files, params, stream_format):
+    """Envia os resultados de um lote na própria resposta, na ordem em que ficam prontos.
+    
+    Nada é gravado em PROCESSED_FOLDER e cada resultado é enviado assim que é codificado,
+    sem acumular o lote inteiro na memória.
+    """
+    positions = []
+    rejected = []
+    for position, file in enumerate(files):
+        if isinstance(file, RemoteFetchError):
+            rejected.append((position, file))
+            continue
+        
+        # Validar o nome do arquivo
+        file_ext = os.path.splitext(secure_filename(file.filename))[1].lower()
+        if file_ext in app.config['UPLOAD_EXTENSIONS']:
+            positions.append(position)
+        else:
+            rejected.append((position, ValueError("Formato de arquivo não permitido")))
+    
+    # A vaga no pool de inferência é verificada aqui, antes do início da resposta. Uma imagem
+    # por vez passa pela inferência, para que o primeiro resultado não espere as demais do lote
+    streams = [files[position].stream for position in positions]
+    outputs = inference_executor.stream(iter_batch_outputs, streams, params, max_images=1)
+    
+    def results():
+        yield from rejected
+        failed = len(rejected)
+        for index, result in outputs:
+            failed += isinstance(result, Exception)
+            yield positions[index], result
+        logger.info(f"Lote enviado em streaming ({stream_format}): {len(files) - failed} imagens processadas, {failed} falhas")
+    
+    encoders = {'ndjson': ndjson_batch_stream, 'multipart': multipart_batch_stream, 'zip': zip_batch_stream}
+    body, mimetype = encoders[stream_format](results(), files, params)
+    response = app.response_class(stream_with_context(body), mimetype=mimetype)
+    if stream_format == 'zip':
+        response.headers['Content-Disposition'] = 'attachment; filename="lote.zip"'
+    # Sem buffer no proxy, para que cada resultado chegue ao cliente assim que é enviado
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def batch_stream_name(position, filename, params):
+    """Nome do resultado de um arquivo do lote: posição no envio, nome original e extensão de saída"""
+    # Para imagens remotas, apenas o último segmento do caminho da URL
+    stem = os.path.splitext(secure_filename(filename.rpartition('/')[2]))[0] or 'imagem'
+    return f"{position}_{stem}{output_media_type(params)[1]}"
+
+def ndjson_batch_stream(results, files, params):
+    """Uma linha JSON por arquivo, com o resultado em base64"""
+    content_type = output_media_type(params)[0]
+    
+    def generate():
+        for position, result in results:
+            entry = {"index": position, "original_name": files[position].filename}
+            if isinstance(result, Exception):
+                entry["error"] = str(result)
+            else:
+                data, cached = result
+                entry.update({
+                    "name": batch_stream_name(position, files[position].filename, params),
+                    "content_type": content_type,
+                    "cached": cached,
+                    "data": base64.b64encode(data).decode('ascii')
+                })
+            yield json.dumps(entry) + '\n'
+    return generate(), 'application/x-ndjson'
+
+def multipart_batch_stream(results, files, params):
+    """Uma parte multipart/mixed por arquivo; as falhas vão em partes JSON"""
+    content_type = output_media_type(params)[0]
+    boundary = uuid.uuid4().hex
+    
+    def generate():
+        for position, result in results:
+            headers = [f"X-Index: {position}"]
+            if isinstance(result, Exception):
+                headers.append('Content-Type: application/json')
+                body = json.dumps({"original_name": files[position].filename, "error": str(result)}).encode()
+            else:
+                body, cached = result
+                name = batch_stream_name(position, files[position].filename, params)
+                headers += [
+                    f"Content-Type: {content_type}",
+                    f'Content-Disposition: attachment; filename="{name}"',
+                    f"X-Cached: {str(cached).lower()}"
+                ]
+            head = f"--{boundary}\r\n" + '\r\n'.join(headers) + '\r\n\r\n'
+            yield head.encode() + body + b'\r\n'
+        yield f"--{boundary}--\r\n".encode()
+    return generate(), f'multipart/mixed; boundary={boundary}'
+
+class _ZipStream:
+    """Destino de escrita do zipfile que entrega os bytes escritos a cada chamada de pop"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def zip_batch_stream(results, files, params):
+    """Arquivo ZIP gerado aos poucos; as falhas são listadas em errors.json no final"""
+    def generate():
+        buffer = _ZipStream()
+        errors = []
+        # Sem compressão: PNG, WebP e AVIF já são comprimidos
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for position, result in results:
+                if isinstance(result, Exception):
+                    errors.append({"index": position, "original_name": files[position].filename, "error": str(result)})
+                    continue
+                name = batch_stream_name(position, files[position].filename, params)
+                archive.writestr(zipfile.ZipInfo(name, time.localtime()[:6]), result[0])
+                yield buffer.pop()
+            if errors:
+                archive.writestr(zipfile.ZipInfo('errors.json', time.localtime()[:6]), json.dumps(errors, ensure_ascii=False))
+        yield buffer.pop()
+    return generate(), 'application/zip'
+
+def submit_batch_job(files, params):
+    """Valida e salva os arquivos de um lote e os enfileira para processamento assíncrono"""
+    job_id = str(uuid.uuid4())
+    items = []
+    
+    for position, file in enumerate(files):
+        if isinstance(file, RemoteFetchError):
+            items.append((file.filename, None, 'failed', str(file)))
+            continue
+        
+        # Validar o nome do arquivo
+        filename = secure_filename(file.filename)
+        file_ext = os.path.splitext(filename)[1].lower()
+        
+        if file_ext not in app.config['UPLOAD_EXTENSIONS']:
+            items.append((file.filename, None, 'failed', "Formato de arquivo não permitido"))
+            continue
+        
+        # Verificar se é uma imagem válida (apenas o cabeçalho é lido aqui)
+        if not validate_image(file.stream):
+            items.append((file.filename, None, 'failed', "Arquivo não é uma imagem válida"))
+            continue
+        
+        input_path = os.path.join(UPLOAD_FOLDER, f"{job_id}_{position}{file_ext}")
+        file.save(input_path)
+        items.append((file.filename, input_path, 'queued', None))
+    
+    enqueue_job(job_id, items, params)
+    queued = sum(1 for item in items if item[2] == 'queued')
+    logger.info(f"Job {job_id} enfileirado: {queued} arquivos, {len(items) - queued} falhas")
+    
+    return jsonify({
+        "status": "queued",
+        "job_id": job_id,
+        "status_url": url_for('get_job_status', job_id=job_id),
+        "message": f"{queued} arquivos enfileirados, {len(items) - queued} falhas"
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_api_key
+@limiter.limit("60 per minute")
+def get_job_status(job_id):
+    """
+    Consulta o progresso de um job de processamento em lote.
+    
+    Parâmetros esperados:
+    - job_id: ID retornado por /batch-remove no modo assíncrono
+    
+    Retorna:
+    - Estado do job e de cada arquivo, com o link de download dos concluídos
+    """
+    # Sanitizar o ID de entrada
+    if not job_id or not all(c.isalnum() or c == '-' for c in job_id):
+        log_security_event('INVALID_JOB_ID', f'ID de job inválido: {job_id}')
+        return jsonify({"error": "ID de job inválido"}), 400
+    
+    result = get_job(job_id)
+    if result is None:
+        return jsonify({"error": "Job não encontrado"}), 404
+    job, items = result
+    
+    counts = {'queued': 0, 'processing': 0, 'done': 0, 'failed': 0}
+    files = []
+    records = result_storage.lookup_many([item['file_id'] for item in items if item['status'] == 'done'])
+    for item in items:
+        counts[item['status']] += 1
+        entry = {
+            "original_name": item['original_name'],
+            "status": item['status']
+        }
+        if item['status'] == 'done':
+            entry["file_id"] = item['file_id']
+            entry["download_url"] = url_for('download_processed_image', file_id=item['file_id'])
+            record = records.get(item['file_id'])
+            if record is not None:
+                entry["url"] = result_url(record['content_hash'], record['format'])
+            entry["cached"] = bool(item['cached'])
+        elif item['status'] == 'failed':
+            entry["error"] = item['error']
+        files.append(entry)
+    
+    # Itens pendentes sem worker de jobs ativo, ou em processamento além de JOB_STALE_SECONDS,
+    # indicam um job parado: o cliente deve ser avisado em vez de consultar indefinidamente
+    stale = False
+    if counts['queued'] + counts['processing'] > 0:
+        status = 'processing' if counts['processing'] or counts['done'] or counts['failed'] else 'queued'
+        stale_before = time.time() - JOB_STALE_SECONDS
+        stale = not job_workers_online() or any(
+            item['status'] == 'processing' and item['claimed_at'] < stale_before for item in items
+        )
+        if stale:
+            logger.warning(f"Job {job_id} parado: {counts['queued'] + counts['processing']} itens pendentes")
+    elif counts['failed'] == 0:
+        status = 'success'
+    elif counts['done'] == 0:
+        status = 'failed'
+    else:
+        status = 'partial_success'
+    
+    return jsonify({
+        "job_id": job_id,
+        "status": status,
+        "created_at": datetime.utcfromtimestamp(job['created_at']).isoformat(),
+        "progress": {
+            "total": job['total'],
+            "done": counts['done'],
+            "failed": counts['failed'],
+            "pending": counts['queued'] + counts['processing']
+        },
+        "stale": stale,
+        "files": files
+    }), 200
+
+def parse_color(value):
+    """Converte '#rrggbb' ou 'r,g,b' em uma tupla (r, g, b)"""
+    value = value.strip()
+    try:
+        if value.startswith('#') and len(value) == 7:
+            color = tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+        else:
+            color = tuple(int(part) for part in value.split(','))
+    except ValueError:
+        color = ()
+    if len(color) != 3 or not all(0 <= c <= 255 for c in color):
+        raise ValueError("Parâmetro background_color inválido. Use #rrggbb ou r,g,b")
+    return color
+
+def load_mask_upload(file):
+    """Lê uma máscara enviada: imagem (canal alfa ou tons de cinza) ou JSON RLE"""
+    if os.path.splitext(secure_filename(file.filename or ''))[1].lower() == RLE_EXTENSION:
+        return decode_mask_rle(file.stream.read())
+    image = load_upload_image(file.stream)
+    return image.getchannel('A') if image.mode in ('RGBA', 'LA') else image.convert('L')
+
+@app.route('/composite', methods=['POST'])
+@require_api_key
+@limiter.limit("60 per minute")
+@megapixel_limit
+def composite_image():
+    """
+    Aplica um recorte já calculado sobre um novo fundo, sem executar o modelo.
+    
+    Parâmetros esperados:
+    - file_id (opcional): ID de um resultado de /remove-background (imagem, máscara ou RLE)
+    - mask (opcional): arquivo de máscara (PNG em tons de cinza ou JSON RLE), em vez de file_id
+    - file (opcional): imagem original; obrigatória quando a máscara não traz as cores
+    - background_color ou background: cor (#rrggbb ou r,g,b) ou imagem de fundo
+    - format, quality, compress_level (opcionais): codificação da saída
+    
+    Retorna:
+    - A imagem composta sobre o fundo
+    """
+    try:
+        params = get_processing_params()
+        if params['output'] != 'image':
+            raise ValueError("O endpoint /composite gera apenas imagens")
+        background_color = request.values.get('background_color', '')
+        background = parse_color(background_color) if background_color else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    file_id = request.values.get('file_id', '')
+    if file_id and not all(c.isalnum() or c == '-' for c in file_id):
+        log_security_event('INVALID_FILE_ID', f'ID de arquivo inválido: {file_id}')
+        return jsonify({"error": "ID de arquivo inválido"}), 400
+    
+    try:
+        foreground = alpha = None
+        if 'background' in request.files and request.files['background'].filename:
+            background = load_upload_image(request.files['background'].stream)
+        if background is None:
+            return jsonify({"error": "Informe background_color ou um arquivo background"}), 400
+        
+        if 'mask' in request.files and request.files['mask'].filename:
+            alpha = load_mask_upload(request.files['mask'])
+        elif file_id:
+            stored_path, stored_format = find_output_file(file_id)
+            if stored_path is None:
+                return jsonify({"error": "Arquivo não encontrado"}), 404
+            if stored_format == 'rle':
+                with open(stored_path, 'rb') as f:
+                    alpha = decode_mask_rle(f.read())
+            else:
+                with Image.open(stored_path) as stored_image:
+                    stored_image.load()
+                    if stored_image.mode == 'RGBA':
+                        # Resultado completo: o recorte já traz as cores originais
+                        foreground = stored_image.convert('RGB')
+                        alpha = stored_image.getchannel('A')
+                    else:
+                        alpha = stored_image.convert('L')
+        else:
+            return jsonify({"error": "Informe file_id ou um arquivo mask"}), 400
+        
+        if 'file' in request.files and request.files['file'].filename:
+            foreground = load_upload_image(request.files['file'].stream)
+            ImageOps.exif_transpose(foreground, in_place=True)
+        if foreground is None:
+            return jsonify({"error": "A máscara não contém as cores da imagem: envie a imagem original em file"}), 400
+    except InvalidImageError as e:
+        log_security_event('INVALID_FILE', str(e))
+        return jsonify({"error": str(e)}), 400
+    except FileNotFoundError:
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    except UnidentifiedImageError:
+        logger.error(f"Resultado armazenado ilegível: {file_id}")
+        return jsonify({"error": "Não foi possível ler o resultado armazenado"}), 500
+    
+    try:
+        output_data = encode_image(composite_on_background(foreground, alpha, background), params)
+        
+        output_id = str(uuid.uuid4())
+        mimetype, output_ext = output_media_type(params)
+        _, content_hash = result_storage.save(output_id, output_data, output_format(params))
+        logger.info(f"Imagem composta: {output_id} a partir de {file_id or 'máscara enviada'}")
+        
+        response = make_response(send_file(
+            io.BytesIO(output_data),
+            mimetype=mimetype,
+            as_attachment=True,
+            download_name=f"composite_{output_id}{output_ext}"
+        ))
+        response.headers['X-Request-ID'] = output_id
+        response.headers['X-Result-URL'] = result_url(content_hash, output_format(params))
+        return response
+    except Exception as e:
+        logger.error(f"Erro ao compor imagem: {str(e)}")
+        return jsonify({"error": f"Erro ao compor imagem: {str(e)}"}), 500
+
 @app.route('/download/<file_id>', methods=['GET'])
 @require_api_key
 @limiter.limit("60 per minute")
@@ -466,9 +3614,10 @@ def download_processed_image(file_id):
     
     Parâmetros esperados:
     - file_id: ID da imagem processada
+    - format (opcional): converte a imagem para png, webp ou avif
     
     Retorna:
-    - A imagem processada
+    - A imagem processada, com ETag forte (hash do conteúdo), 304 e suporte a Range
     """
     try:
         # Sanitizar o ID de entrada para evitar path traversal
@@ -476,32 +3625,98 @@ def download_processed_image(file_id):
             log_security_event('INVALID_FILE_ID', f'ID de arquivo inválido: {file_id}')
             return jsonify({"error": "ID de arquivo inválido"}), 400
             
+        try:
+            params = get_processing_params()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
         # Verificar se o arquivo existe
-        output_path = os.path.join(PROCESSED_FOLDER, f"{file_id}_output.png")
+        record = result_storage.lookup(file_id)
         
-        if not os.path.exists(output_path):
+        if record is None:
             logger.error(f"Arquivo não encontrado: {file_id}")
             return jsonify({"error": "Arquivo não encontrado"}), 404
         
         logger.info(f"Enviando arquivo processado: {file_id}")
+        stored_format = record['format']
         
-        # Verificar o tempo de criação do arquivo - opcionalmente poderia expirar arquivos antigos
-        file_age = time.time() - os.path.getctime(output_path)
-        if file_age > 86400 * 7:  # 7 dias
-            logger.warning(f"Arquivo com mais de 7 dias: {file_id}")
+        if stored_format == 'rle':
+            if 'format' in request.values:
+                return jsonify({"error": "Máscaras RLE não podem ser convertidas para imagem"}), 400
+            return send_stored_result(record, f"mask_{file_id}{RLE_EXTENSION}", 'private, no-cache')
         
-        return send_file(
-            output_path,
-            mimetype='image/png',
-            as_attachment=True,
-            download_name=f"no_bg_{file_id}.png"
-        )
+        # Converter apenas quando o formato pedido for diferente do armazenado
+        if 'format' in request.values and params['format'] != stored_format:
+            _, mimetype, output_ext = OUTPUT_FORMATS[params['format']]
+            with Image.open(record['path']) as stored_image:
+                output_data = encode_image(stored_image, params)
+            response = send_file(
+                io.BytesIO(output_data),
+                mimetype=mimetype,
+                as_attachment=True,
+                download_name=f"no_bg_{file_id}{output_ext}"
+            )
+            response.headers['Cache-Control'] = 'no-store'
+            return response
+        
+        # O ID exige API key: o cliente pode guardar a resposta e revalidá-la pelo ETag
+        output_ext = OUTPUT_FORMATS[stored_format][2]
+        return send_stored_result(record, f"no_bg_{file_id}{output_ext}", 'private, no-cache')
         
+    except FileNotFoundError:
+        # Registrado no índice, mas removido do disco
+        logger.error(f"Arquivo não encontrado no disco: {file_id}")
+        return jsonify({"error": "Arquivo não encontrado"}), 404
+    except UnidentifiedImageError:
+        # Formato armazenado sem suporte neste processo (por exemplo, AVIF sem o plugin)
+        logger.error(f"Resultado armazenado ilegível: {file_id}")
+        return jsonify({"error": "Não foi possível ler o resultado armazenado"}), 500
     except Exception as e:
         logger.error(f"Erro ao enviar arquivo: {str(e)}")
         return jsonify({"error": f"Erro ao enviar arquivo: {str(e)}"}), 500
 
+@app.route('/results/<name>', methods=['GET'])
+@limiter.limit("120 per minute")
+def get_result(name):
+    """
+    Serve um resultado pela URL imutável derivada do hash do conteúdo.
+    
+    A URL (retornada em X-Result-URL e nos JSONs de lote e de jobs) não exige API key:
+    o hash SHA-256 do conteúdo não pode ser adivinhado. Como o conteúdo de uma URL nunca
+    muda, a resposta pode ser guardada por navegadores e CDNs por RESULT_MAX_AGE segundos.
+    """
+    content_hash, ext = os.path.splitext(name)
+    if len(content_hash) != 64 or not all(c in '0123456789abcdef' for c in content_hash):
+        return jsonify({"error": "Resultado não encontrado"}), 404
+    
+    record = result_storage.lookup_hash(content_hash)
+    stored_ext = None
+    if record is not None:
+        stored_ext = RLE_EXTENSION if record['format'] == 'rle' else OUTPUT_FORMATS[record['format']][2]
+    if stored_ext != ext:
+        return jsonify({"error": "Resultado não encontrado"}), 404
+    
+    try:
+        return send_stored_result(record, f"no_bg_{content_hash[:16]}{ext}", f"public, max-age={RESULT_MAX_AGE}, immutable")
+    except FileNotFoundError:
+        return jsonify({"error": "Resultado não encontrado"}), 404
+
 # Tratamento de erros
+@app.errorhandler(InferenceQueueFull)
+def inference_queue_full(e):
+    log_security_event('SERVER_BUSY', 'Fila de processamento cheia', level=logging.WARNING)
+    response = jsonify({"error": "Servidor ocupado. Tente novamente em alguns segundos"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(INFERENCE_RETRY_AFTER)
+    return response
+
+@app.errorhandler(ModelUnavailable)
+def model_unavailable(e):
+    response = jsonify({"error": f"Modelo {e} ainda não disponível neste servidor. Tente novamente em alguns segundos"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(INFERENCE_RETRY_AFTER)
+    return response
+
 @app.errorhandler(404)
 def page_not_found(e):
     return jsonify({"error": "Página não encontrada"}), 404
@@ -519,13 +3734,33 @@ def request_entity_too_large(e):
 def bad_request(e):
     return jsonify({"error": "Requisição inválida"}), 400
 
+@app.errorhandler(429)
+def rate_limit_exceeded(e):
+    log_security_event('RATE_LIMITED', f'Limite excedido: {e.description}')
+    # Os cabeçalhos X-RateLimit-* e Retry-After são acrescentados pelo limitador
+    return jsonify({"error": f"Limite de requisições excedido: {e.description}"}), 429
+
 @app.errorhandler(500)
 def internal_server_error(e):
     logger.error(f"Erro interno do servidor: {str(e)}")
     return jsonify({"error": "Erro interno do servidor"}), 500
 
+startup_timings['app_import_ms'] = round((time.perf_counter() - _import_started) * 1000, 1)
+
+def warm_up_default_model():
+    """Carrega e aquece o modelo padrão; erros ficam registrados no estado da sessão"""
+    try:
+        rembg_sessions.get()
+    except Exception as e:
+        logger.error(f"Falha ao pré-carregar o modelo: {str(e)}")
+
 if __name__ == '__main__':
     logger.info("Iniciando servidor de API para remoção de fundo de imagens")
-    # Iniciar o agendador de limpeza de arquivos
-    schedule_cleanup(app)
-    app.run(debug=False, host='0.0.0.0', port=5000) 
\ No newline at end of file
+    # Iniciar a limpeza de arquivos e os workers da fila de jobs assíncronos
+    background_services = start_background_services()
+    # O servidor aceita conexões enquanto o modelo carrega; /ready responde 200 ao final
+    threading.Thread(target=warm_up_default_model, name='warm-up', daemon=True).start()
+    try:
+        app.run(debug=False, host='0.0.0.0', port=5000)
+    finally:
+        background_services.terminate() 
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+Benchmark do pipeline de remoção de fundo.
+
+Executa a API (via app.test_client()) e a função process_image_remove_bg sobre um
+conjunto sintético de imagens de vários tamanhos e formatos, e reporta latência
+(p50/p95/p99), imagens por segundo, pico de memória (RSS) e o tempo de cada etapa
+(decode, validate, resize, inference, composite, encode, disk_write).
+
+Também mede a partida a frio: um processo novo importa o app, carrega e aquece o modelo
+e atende a primeira requisição.
+
+Roda offline, em CPU, com o modelo já presente no diretório do rembg (~/.u2net ou
+U2NET_HOME). Exemplo:
+
+    python benchmark.py --iterations 20 --sizes 640x480,1920x1080 --formats jpeg,png
+    python benchmark.py --json resultado.json
+    python benchmark.py --baseline resultado.json --tolerance 0.15
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+API_KEY = 'benchmark'
+
+STAGES = ['decode', 'validate', 'resize', 'inference', 'composite', 'encode', 'disk_write']
+PIL_FORMATS = {'jpeg': ('JPEG', '.jpg'), 'png': ('PNG', '.png'), 'webp': ('WEBP', '.webp')}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark do pipeline de remoção de fundo")
+    parser.add_argument('--iterations', type=int, default=10, help="medições por cenário")
+    parser.add_argument('--warmup', type=int, default=2, help="execuções descartadas antes de medir")
+    parser.add_argument('--sizes', default='320x240,1024x768,2000x1500', help="tamanhos LxA separados por vírgula")
+    parser.add_argument('--formats', default='jpeg,png', help="formatos de entrada: jpeg, png, webp")
+    parser.add_argument('--output-format', default='png', help="formato de saída pedido à API")
+    parser.add_argument('--mode', choices=['client', 'direct', 'both'], default='both',
+                        help="client: requisições via test_client; direct: process_image_remove_bg")
+    parser.add_argument('--model', default=os.getenv('REMBG_MODEL', 'u2net'), help="modelo do rembg")
+    parser.add_argument('--with-cache', action='store_true',
+                        help="mantém o cache de resultados ativo e repete a mesma entrada em cada cenário")
+    parser.add_argument('--cold-starts', type=int, default=3, help="processos novos medidos na partida a frio (0 desativa)")
+    parser.add_argument('--json', dest='json_path', help="grava os resultados em JSON")
+    parser.add_argument('--baseline', help="JSON de uma execução anterior para comparar o p95")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="aumento máximo aceito do p95 em relação ao baseline (0.15 = 15%%)")
+    return parser.parse_args()
+
+
+def model_path(model_name):
+    """Caminho onde o rembg procura o arquivo do modelo"""
+    home = os.getenv('U2NET_HOME', os.path.join(os.getenv('XDG_DATA_HOME', '~'), '.u2net'))
+    return os.path.join(os.path.expanduser(home), f"{model_name}.onnx")
+
+
+def synthetic_image(width, height, seed):
+    """Gera uma imagem determinística com fundo em gradiente, um objeto e ruído"""
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.empty((height, width, 3), dtype=np.float32)
+    pixels[..., 0] = 255 * x / max(width - 1, 1)
+    pixels[..., 1] = 255 * y / max(height - 1, 1)
+    pixels[..., 2] = 128
+
+    # Objeto elíptico no centro, com cor própria
+    cx, cy = width / 2, height / 2
+    inside = ((x - cx) / (width * 0.3)) ** 2 + ((y - cy) / (height * 0.35)) ** 2 <= 1
+    pixels[inside] = rng.randint(0, 255, 3)
+
+    pixels += rng.normal(0, 8, pixels.shape)
+    return Image.fromarray(pixels.clip(0, 255).astype(np.uint8), mode='RGB')
+
+
+def encode_input(image, pil_format):
+    buffer = io.BytesIO()
+    if pil_format == 'PNG':
+        image.save(buffer, format='PNG')
+    else:
+        image.save(buffer, format=pil_format, quality=90)
+    return buffer.getvalue()
+
+
+def build_corpus(sizes, formats):
+    """Codifica as imagens sintéticas em cada formato de entrada"""
+    corpus = []
+    for index, (width, height) in enumerate(sizes):
+        image = synthetic_image(width, height, seed=index)
+        for name in formats:
+            pil_format, ext = PIL_FORMATS[name]
+            corpus.append({
+                'name': f"{width}x{height}.{name}",
+                'filename': f"bench_{width}x{height}{ext}",
+                'image': image,
+                'pil_format': pil_format,
+                'data': encode_input(image, pil_format),
+                'megapixels': width * height / 1e6,
+            })
+    return corpus
+
+
+def varied_input(item, counter):
+    """Cópia da entrada com o pixel central alterado, para que cada execução gere um resultado novo.
+    
+    Resultados idênticos são gravados uma única vez no armazenamento (os IDs seguintes só
+    apontam para o mesmo arquivo): com a mesma entrada repetida, disk_write seria medido
+    apenas na primeira execução.
+    """
+    image = item['image'].copy()
+    # Passos grandes de cor: a quantização do JPEG não desfaz a alteração
+    image.putpixel((image.width // 2, image.height // 2), (counter * 97 % 256, counter * 53 % 256, counter * 29 % 256))
+    return dict(item, data=encode_input(image, item['pil_format']))
+
+
+# Executado em um processo novo: importação, carga e aquecimento do modelo e primeira requisição
+COLD_START_SCRIPT = """
+import io, json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {repo_dir!r})
+import app
+imported = time.perf_counter()
+app.limiter.enabled = False
+app.rembg_sessions.get()
+ready = time.perf_counter()
+from PIL import Image
+buffer = io.BytesIO()
+Image.new('RGB', (640, 480), (40, 90, 160)).save(buffer, format='JPEG')
+response = app.app.test_client().post(
+    '/remove-background',
+    data={{'file': (io.BytesIO(buffer.getvalue()), 'cold.jpg')}},
+    headers={{'X-API-Key': {api_key!r}}},
+)
+done = time.perf_counter()
+model = app.rembg_sessions.status()
+print(json.dumps({{
+    'status': response.status_code,
+    'import_ms': (imported - start) * 1000,
+    'rembg_import_ms': app.startup_timings.get('rembg_import_ms', 0.0),
+    'model_load_ms': model.get('load_time_ms', 0.0),
+    'warmup_ms': model.get('warmup_ms', 0.0),
+    'ready_ms': (ready - start) * 1000,
+    'first_request_ms': (done - ready) * 1000,
+}}))
+"""
+
+
+def measure_cold_start(runs):
+    """Mediana dos tempos de partida de processos novos; total_ms inclui o início do interpretador"""
+    samples = []
+    script = COLD_START_SCRIPT.format(repo_dir=REPO_DIR, api_key=API_KEY)
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        if sample.pop('status') != 200:
+            raise RuntimeError("partida a frio: a primeira requisição falhou")
+        sample['total_ms'] = (time.perf_counter() - start) * 1000
+        samples.append(sample)
+    return {name: float(np.median([sample[name] for sample in samples])) for name in samples[0]}
+
+
+def peak_rss_mb():
+    """Pico de memória residente do processo (ru_maxrss é em KB no Linux e em bytes no macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def parse_server_timing(header):
+    """Converte o cabeçalho Server-Timing em {etapa: segundos}"""
+    timings = {}
+    for entry in filter(None, (part.strip() for part in (header or '').split(','))):
+        name, _, duration = entry.partition(';dur=')
+        if duration:
+            timings[name] = float(duration) / 1000
+    return timings
+
+
+def run_client(app_module, client, item, output_format):
+    """Envia uma imagem para /remove-background e retorna (latência, tempos por etapa)"""
+    start = time.perf_counter()
+    response = client.post(
+        '/remove-background',
+        data={'file': (io.BytesIO(item['data']), item['filename']), 'format': output_format},
+        headers={'X-API-Key': API_KEY},
+    )
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f"{item['name']}: status {response.status_code} - {response.get_data(as_text=True)}")
+    return elapsed, parse_server_timing(response.headers.get('Server-Timing'))
+
+
+def run_direct(app_module, client, item, output_format):
+    """Executa decode, processamento e codificação sem passar pela camada HTTP"""
+    timings = app_module.start_stage_timings()
+    start = time.perf_counter()
+    image = app_module.load_upload_image(io.BytesIO(item['data']))
+    output_image = app_module.process_image_remove_bg(image)
+    app_module.encode_image(output_image, {
+        'format': output_format,
+        'quality': app_module.DEFAULT_OUTPUT_QUALITY,
+        'compress_level': app_module.DEFAULT_PNG_COMPRESS_LEVEL,
+    })
+    elapsed = time.perf_counter() - start
+    return elapsed, dict(timings)
+
+
+def summarize(latencies, stage_samples, megapixels):
+    latencies = np.array(latencies)
+    total = float(latencies.sum())
+    summary = {
+        'count': int(len(latencies)),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p95_ms': float(np.percentile(latencies, 95) * 1000),
+        'p99_ms': float(np.percentile(latencies, 99) * 1000),
+        'mean_ms': float(latencies.mean() * 1000),
+        'images_per_sec': len(latencies) / total if total > 0 else 0.0,
+        'megapixels': megapixels,
+        'stages_ms': {},
+    }
+    for stage in STAGES + sorted(set().union(*stage_samples) - set(STAGES)):
+        values = [sample.get(stage, 0.0) for sample in stage_samples]
+        if any(values):
+            summary['stages_ms'][stage] = {
+                'mean': float(np.mean(values) * 1000),
+                'p95': float(np.percentile(values, 95) * 1000),
+            }
+    return summary
+
+
+def print_report(results):
+    header = f"{'cenário':<28}{'p50':>9}{'p95':>9}{'p99':>9}{'img/s':>8}  etapas (média ms)"
+    print(header)
+    print('-' * len(header))
+    for name, summary in results['scenarios'].items():
+        stages = ' '.join(f"{stage}={values['mean']:.1f}" for stage, values in summary['stages_ms'].items())
+        print(f"{name:<28}{summary['p50_ms']:>9.1f}{summary['p95_ms']:>9.1f}{summary['p99_ms']:>9.1f}"
+              f"{summary['images_per_sec']:>8.2f}  {stages}")
+    print(f"\nPico de RSS: {results['peak_rss_mb']:.1f} MB")
+    cold_start = results.get('cold_start')
+    if cold_start:
+        print(f"Partida a frio (mediana): pronto em {cold_start['ready_ms']:.0f}ms "
+              f"(import do app {cold_start['import_ms']:.0f}ms, rembg {cold_start['rembg_import_ms']:.0f}ms, "
+              f"modelo {cold_start['model_load_ms']:.0f}ms, aquecimento {cold_start['warmup_ms']:.0f}ms), "
+              f"primeira requisição {cold_start['first_request_ms']:.0f}ms, processo completo {cold_start['total_ms']:.0f}ms")
+
+
+def compare_baseline(results, baseline_path, tolerance):
+    """Retorna a lista de cenários cujo p95 piorou além da tolerância"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressions = []
+    for name, summary in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if previous and summary['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']:.1f}ms -> {summary['p95_ms']:.1f}ms")
+    return regressions
+
+
+def main():
+    args = parse_args()
+
+    if not os.path.exists(model_path(args.model)):
+        sys.exit(f"Modelo {args.model} não encontrado em {model_path(args.model)}. "
+                 "Baixe-o antes de rodar o benchmark (ele roda offline).")
+
+    # Caminhos relativos são resolvidos a partir do diretório atual, antes da troca para o temporário
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    # Configuração isolada: diretórios temporários, API key própria e cache desativado
+    os.environ['REMBG_MODEL'] = args.model
+    os.environ['API_KEYS'] = API_KEY
+    os.environ.setdefault('MODEL_CHECKSUM_DISABLED', '1')
+    if not args.with_cache:
+        os.environ['RESULT_CACHE_MEMORY_BYTES'] = '0'
+        os.environ['RESULT_CACHE_DISK_BYTES'] = '0'
+        os.environ['NEAR_DUPLICATE_THRESHOLD'] = '0'
+    workdir = tempfile.mkdtemp(prefix='rembg-bench-')
+    os.chdir(workdir)
+    
+    # Medida antes de importar o app neste processo, com a mesma configuração
+    cold_start = measure_cold_start(args.cold_starts) if args.cold_starts > 0 else None
+    
+    sys.path.insert(0, REPO_DIR)
+
+    import app as app_module
+    app_module.limiter.enabled = False
+    app_module.app.root_path = workdir
+    client = app_module.app.test_client()
+
+    sizes = [tuple(int(v) for v in size.split('x')) for size in args.sizes.split(',')]
+    corpus = build_corpus(sizes, [name.strip() for name in args.formats.split(',')])
+    modes = ['client', 'direct'] if args.mode == 'both' else [args.mode]
+    runners = {'client': run_client, 'direct': run_direct}
+
+    load_start = time.perf_counter()
+    app_module.rembg_sessions.get()
+    results = {
+        'model': args.model,
+        'model_load_ms': (time.perf_counter() - load_start) * 1000,
+        'output_format': args.output_format,
+        'cold_start': cold_start,
+        'scenarios': {},
+    }
+
+    # Sem o cache, cada execução recebe uma entrada diferente (ver varied_input)
+    counter = itertools.count()
+    for mode in modes:
+        for item in corpus:
+            runner = runners[mode]
+            for _ in range(args.warmup):
+                runner(app_module, client, item, args.output_format)
+            latencies, stage_samples = [], []
+            for _ in range(args.iterations):
+                run_item = item if args.with_cache else varied_input(item, next(counter))
+                elapsed, timings = runner(app_module, client, run_item, args.output_format)
+                latencies.append(elapsed)
+                stage_samples.append(timings)
+            results['scenarios'][f"{mode}:{item['name']}"] = summarize(latencies, stage_samples, item['megapixels'])
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    print_report(results)
+
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline_path:
+        regressions = compare_baseline(results, baseline_path, args.tolerance)
+        if regressions:
+            print("\nRegressões de desempenho:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,19 +7,62 @@ port = int(os.environ.get("PORT", 5000))
 bind = f"0.0.0.0:{port}"
 
 # Configurações de workers
-# Reduzido para evitar consumo excessivo de memória
-workers = 2  # Valor fixo baixo em vez de workers = multiprocessing.cpu_count()
-worker_class = "sync"
-threads = 1
+# Os pesos do modelo ficam em um arquivo mapeado em memória e compartilhado entre os workers
+# (MODEL_SHARED_WEIGHTS), então cada worker adicional custa apenas a memória das inferências
+cpu_count = multiprocessing.cpu_count()
+workers = int(os.environ.get("GUNICORN_WORKERS") or max(2, cpu_count // 2))
+
+# Threads de I/O (gthread): uploads e downloads lentos ocupam uma thread, não o worker inteiro.
+# O processamento de imagens roda em um executor de CPU limitado (INFERENCE_WORKERS por worker),
+# que responde 503 com Retry-After quando a fila (INFERENCE_QUEUE_SIZE) está cheia.
+# Use GUNICORN_WORKER_CLASS=sync e GUNICORN_THREADS=1 para o modo anterior.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Dividir os núcleos entre os workers para o ONNX Runtime não disputar CPU entre processos
+os.environ.setdefault("INFERENCE_WORKERS", "1")
+
+# Cada thread ocupa no máximo uma vaga do executor (INFERENCE_WORKERS + INFERENCE_QUEUE_SIZE).
+# Com vagas demais, todas as threads ficam presas esperando e nenhuma sobra para responder 503:
+# a fila fica limitada a threads - INFERENCE_WORKERS - 1 (o padrão)
+max_inference_queue = max(threads - int(os.environ["INFERENCE_WORKERS"]) - 1, 0)
+os.environ["INFERENCE_QUEUE_SIZE"] = str(min(int(os.environ.get("INFERENCE_QUEUE_SIZE") or max_inference_queue), max_inference_queue))
+os.environ.setdefault("ORT_INTRA_OP_THREADS", str(max(1, cpu_count // (workers * int(os.environ["INFERENCE_WORKERS"])))))
+
+def container_memory_limit():
+    """Limite de memória do contêiner (cgroup v2 ou v1), em bytes, ou a memória física se não houver limite"""
+    physical = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # "max" (v2) ou um valor acima da memória física (v1) significam sem limite
+        if value != "max" and int(value) < physical:
+            return int(value)
+    return physical
+
+# Limite de memória para reciclar cada worker (ver post_request): por padrão, 3/4 do limite do
+# contêiner divididos entre os workers do Gunicorn e os de jobs (JOB_WORKERS). O quarto restante
+# fica para o master, os pesos compartilhados do modelo e o cache de páginas. No plano standard
+# do Render (2GB), com 2 workers e 1 worker de jobs, são 512MB por worker.
+if not os.environ.get("WORKER_MAX_MEMORY_MB"):
+    process_count = workers + int(os.environ.get("JOB_WORKERS", 1))
+    os.environ["WORKER_MAX_MEMORY_MB"] = str(max(256, container_memory_limit() * 3 // 4 // process_count // (1024 * 1024)))
 
 # Timeouts
 timeout = 120  # Aumentado para permitir processamento de imagens grandes
 graceful_timeout = 30
 keepalive = 5
 
-# Limite de memória - reiniciar worker após processar N requisições
-max_requests = 50
-max_requests_jitter = 10
+# Sem reciclagem por número de requisições: o worker só é reiniciado quando a memória passa
+# de WORKER_MAX_MEMORY_MB (ver post_request). GUNICORN_MAX_REQUESTS reativa a reciclagem fixa.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 5
+
+# Métricas do Prometheus agregadas entre os workers (ver /metrics)
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-metrics")
 
 # Logs
 errorlog = "logs/gunicorn-error.log"
@@ -37,4 +80,74 @@ user = None
 group = None
 
 # Configurações avançadas
-preload_app = True  # Carregar o aplicativo antes de distribuir para os workers 
\ No newline at end of file
+preload_app = True  # Carregar o aplicativo antes de distribuir para os workers 
+
+
+# Processo auxiliar com a limpeza periódica e os workers de jobs (ver when_ready)
+background_services = None
+
+
+def on_starting(server):
+    """Limpa as métricas de execuções anteriores antes de iniciar os workers"""
+    import shutil
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Descarta as métricas de gauges do worker encerrado"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    """Esquece, no worker, os processos filhos do master registrados pelo multiprocessing.
+    
+    Sem isso, ao sair, cada worker (inclusive os reciclados por memória) tentaria terminar e
+    aguardar o processo auxiliar do master (ver when_ready), que não é filho dele.
+    """
+    import multiprocessing.process
+    multiprocessing.process._children.clear()
+
+
+def post_worker_init(worker):
+    """Carrega e aquece a sessão do modelo em cada worker logo após o fork, antes da primeira requisição"""
+    from app import warm_up_default_model
+    warm_up_default_model()
+
+
+def post_request(worker, req, environ, resp):
+    """Recicla o worker quando a memória anônima passa de WORKER_MAX_MEMORY_MB.
+    
+    Com alive = False, o worker termina as requisições em andamento, deixa de aceitar novas
+    e é substituído pelo master, como na reciclagem por max_requests.
+    """
+    from app import memory_limit_exceeded, process_memory, WORKER_MAX_MEMORY_MB
+    if worker.alive and memory_limit_exceeded():
+        worker.log.warning(
+            f"Worker {worker.pid} com {process_memory()['anon'] // (1024 * 1024)}MB de memória anônima "
+            f"(limite {WORKER_MAX_MEMORY_MB}MB): reciclando"
+        )
+        worker.alive = False
+
+
+def when_ready(server):
+    """Inicia, a partir do master, o processo auxiliar com a limpeza periódica e os workers de jobs.
+    
+    Chamado antes da criação dos workers. O app (e com ele o rembg: pymatting, numba, scipy,
+    OpenCV) já foi importado na thread principal do master (preload_app) e é herdado pelos
+    workers do Gunicorn, criados por fork. A limpeza e o supervisor dos workers de jobs rodam em
+    um processo criado com spawn (ver start_background_services), não em threads do master.
+    """
+    global background_services
+    from app import start_background_services, startup_timings
+    server.log.info(f"rembg importado em {startup_timings['rembg_import_ms']:.0f}ms")
+    background_services = start_background_services()
+
+
+def on_exit(server):
+    """Encerra o processo auxiliar (e, com ele, os workers de jobs) junto com o master"""
+    if background_services is not None:
+        background_services.terminate()
+        background_services.join(graceful_timeout)
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# O app cria pastas e bancos SQLite relativos ao diretório atual: os testes rodam em um diretório temporário
+os.chdir(tempfile.mkdtemp(prefix='bg-remover-tests-'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.update({
+    'API_KEYS': 'test-key',
+    'RATELIMIT_STORAGE_URI': 'memory://',
+    'REMOTE_URL_ALLOWED_HOSTS': '127.0.0.1,.example.com',
+    'REMOTE_URL_ALLOW_PRIVATE': 'True',
+    'REMOTE_FETCH_MAX_BYTES': '200000',
+    'REMOTE_FETCH_TIMEOUT': '1',
+})
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+import app
+
+API_HEADERS = {'X-API-Key': 'test-key'}
+
+
+@pytest.fixture
+def jobs_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'JOBS_DB_PATH', str(tmp_path / 'jobs.db'))
+    app.init_jobs_db()
+    conn = app.get_jobs_db()
+    yield conn
+    conn.close()
+
+
+def enqueue(job_id, count):
+    items = [(f'{index}.jpg', f'/nao-existe/{index}.jpg', 'queued', None) for index in range(count)]
+    app.enqueue_job(job_id, items, {'model': 'u2net'})
+
+
+def statuses(conn):
+    return [tuple(row) for row in conn.execute('SELECT status, attempts, worker_pid FROM job_items ORDER BY id')]
+
+
+def test_claim_records_worker_and_attempt(jobs_db):
+    enqueue('job-1', 2)
+    assert len(app.claim_job_items(jobs_db, 10)) == 2
+    assert statuses(jobs_db) == [('processing', 1, os.getpid())] * 2
+    assert app.claim_job_items(jobs_db, 10) == []
+
+
+def test_items_of_dead_worker_are_requeued(jobs_db):
+    enqueue('job-1', 2)
+    app.claim_job_items(jobs_db, 1)
+    assert app.requeue_job_items(jobs_db, os.getpid()) == (1, 0)
+    assert statuses(jobs_db) == [('queued', 1, None), ('queued', 0, None)]
+    # Itens de outros workers não são afetados
+    app.claim_job_items(jobs_db, 10)
+    assert app.requeue_job_items(jobs_db, os.getpid() + 1) == (0, 0)
+
+
+def test_item_that_keeps_crashing_workers_fails(jobs_db):
+    enqueue('job-1', 1)
+    for _ in range(app.JOB_MAX_ATTEMPTS - 1):
+        app.claim_job_items(jobs_db, 10)
+        assert app.requeue_job_items(jobs_db, os.getpid()) == (1, 0)
+    app.claim_job_items(jobs_db, 10)
+    assert app.requeue_job_items(jobs_db, os.getpid()) == (0, 1)
+    status, attempts, _ = statuses(jobs_db)[0]
+    assert (status, attempts) == ('failed', app.JOB_MAX_ATTEMPTS)
+    assert app.claim_job_items(jobs_db, 10) == []
+
+
+def test_job_without_workers_is_reported_stale(jobs_db):
+    enqueue('job-1', 1)
+    with app.app.test_client() as client:
+        response = client.get('/jobs/job-1', headers=API_HEADERS)
+        assert response.status_code == 200
+        assert response.json['status'] == 'queued'
+        assert response.json['stale'] is True
+        
+        jobs_db.execute('INSERT INTO job_workers (pid, started_at, seen_at) VALUES (1, ?, ?)', (0, 4e9))
+        assert client.get('/jobs/job-1', headers=API_HEADERS).json['stale'] is False
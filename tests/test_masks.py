@@ -0,0 +1,44 @@
+import json
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import app
+
+
+def test_rle_round_trip():
+    pixels = np.zeros((37, 53), dtype=np.uint8)
+    pixels[5:30, 10:40] = 255
+    pixels[12, :] = 128
+    mask = Image.fromarray(pixels, mode='L')
+    data = app.encode_mask_rle(mask)
+    rle = json.loads(data)
+    assert (rle['width'], rle['height']) == (53, 37)
+    assert sum(rle['counts']) == 53 * 37
+    assert np.array_equal(np.asarray(app.decode_mask_rle(data)), pixels)
+
+
+def test_rle_single_run():
+    mask = Image.new('L', (8, 4), 255)
+    assert json.loads(app.encode_mask_rle(mask))['counts'] == [32]
+    assert np.asarray(app.decode_mask_rle(app.encode_mask_rle(mask))).min() == 255
+
+
+@pytest.mark.parametrize('rle', [
+    b'not json',
+    {'width': 2, 'height': 2, 'values': [0], 'counts': [3]},
+    {'width': 2, 'height': 2, 'values': [0, 300], 'counts': [2, 2]},
+    {'width': 2, 'height': 2, 'values': [0], 'counts': [4, 0]},
+    {'width': 2, 'values': [0], 'counts': [4]},
+])
+def test_invalid_rle(rle):
+    data = rle if isinstance(rle, bytes) else json.dumps(rle).encode()
+    with pytest.raises(app.InvalidImageError):
+        app.decode_mask_rle(data)
+
+
+def test_oversized_rle():
+    data = json.dumps({'width': 10, 'height': 10, 'values': [0], 'counts': [100]}).encode()
+    with pytest.raises(app.OversizedImageError):
+        app.decode_mask_rle(data, max_dimension=5)
@@ -0,0 +1,198 @@
+import io
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+import app
+
+API_HEADERS = {'X-API-Key': 'test-key'}
+
+
+def jpeg_bytes(size=(64, 48)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Servidor HTTP local no lugar do armazenamento de objetos"""
+
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        path = self.path.split('?')[0]
+        if path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', self.path[len('/redirect/'):])
+            self.end_headers()
+        elif path == '/big-declared.jpg':
+            self.send_response(200)
+            self.send_header('Content-Length', '300000')
+            self.end_headers()
+        elif path == '/big-streamed.jpg':
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'x' * 300000)
+        elif path == '/slow.jpg':
+            self.send_response(200)
+            self.end_headers()
+            for _ in range(10):
+                self.wfile.write(b'x' * 10)
+                self.wfile.flush()
+                time.sleep(0.3)
+        elif path.startswith('/image'):
+            data = jpeg_bytes()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+@pytest.fixture
+def hits():
+    StandInHandler.hits.clear()
+    return StandInHandler.hits
+
+
+@pytest.fixture
+def fetcher():
+    return app.RemoteImageFetcher(['127.0.0.1'], True, timeout=1, max_bytes=200000, max_workers=2)
+
+
+@pytest.fixture
+def client():
+    app.limiter.reset()
+    return app.app.test_client()
+
+
+def test_host_allowlist():
+    fetcher = app.RemoteImageFetcher(['.example.com', '*.b.org', 'c.net'], False, 1, 1, 1)
+    assert fetcher.host_allowed('example.com')
+    assert fetcher.host_allowed('img.example.com')
+    assert not fetcher.host_allowed('badexample.com')
+    assert fetcher.host_allowed('x.b.org')
+    assert fetcher.host_allowed('c.net')
+    assert not fetcher.host_allowed('img.c.net')
+    assert app.RemoteImageFetcher(['*'], False, 1, 1, 1).host_allowed('qualquer.com')
+
+
+@pytest.mark.parametrize('manifest, urls', [
+    (b'http://a/1.jpg\nhttp://a/2.jpg\n', ['http://a/1.jpg', 'http://a/2.jpg']),
+    (b'id,URL\n1,http://a/1.jpg\n2,\n', ['http://a/1.jpg']),
+    (b'["http://a/1.jpg", {"url": "http://a/2.jpg"}]', ['http://a/1.jpg', 'http://a/2.jpg']),
+    (b'{"urls": ["http://a/1.jpg"]}', ['http://a/1.jpg']),
+])
+def test_parse_manifest(manifest, urls):
+    assert app.parse_url_manifest(manifest) == urls
+
+
+@pytest.mark.parametrize('manifest', [b'[1, 2]', b'{"urls": "x"}', b'[', b'\xff\xfe'])
+def test_parse_invalid_manifest(manifest):
+    with pytest.raises(app.RemoteURLError):
+        app.parse_url_manifest(manifest)
+
+
+def test_fetch_image(server, fetcher):
+    file = fetcher.fetch(server + '/image?signature=secret')
+    assert file.filename == server + '/image.jpg'  # Sem a query; extensão pelo Content-Type
+    assert Image.open(file.stream).size == (64, 48)
+
+
+@pytest.mark.parametrize('path, message', [
+    ('/missing.jpg', 'HTTP 404'),
+    ('/big-declared.jpg', 'muito grande'),
+    ('/big-streamed.jpg', 'muito grande'),
+    ('/slow.jpg', 'tempo esgotado'),
+])
+def test_fetch_errors(server, fetcher, path, message):
+    with pytest.raises(app.RemoteFetchError, match=message):
+        fetcher.fetch(server + path)
+
+
+def test_redirects_are_validated(server, fetcher):
+    assert fetcher.fetch(f'{server}/redirect/{server}/image.jpg').filename.endswith('.jpg')
+    with pytest.raises(app.RemoteFetchError, match='Host não permitido'):
+        fetcher.fetch(f'{server}/redirect/http://10.0.0.1/image.jpg')
+
+
+@pytest.mark.parametrize('url', [
+    'file:///etc/passwd',
+    'ftp://127.0.0.1/image.jpg',
+    'http://169.254.169.254/latest/meta-data',
+    'http://example.org/image.jpg',
+])
+def test_rejected_urls(fetcher, url):
+    with pytest.raises(app.RemoteFetchError):
+        fetcher.fetch(url)
+
+
+def test_private_addresses_blocked(server, hits):
+    fetcher = app.RemoteImageFetcher(['127.0.0.1', 'localhost'], False, 1, 200000, 1)
+    for url in (server + '/image.jpg', server.replace('127.0.0.1', 'localhost') + '/image.jpg'):
+        with pytest.raises(app.RemoteFetchError, match='Host não permitido'):
+            fetcher.fetch(url)
+    assert hits == []
+
+
+def test_single_route_rejects_extra_urls_before_fetching(server, client, hits):
+    response = client.post('/remove-background', data={'url': [f'{server}/image{i}.jpg' for i in range(40)]},
+                           headers=API_HEADERS)
+    assert response.status_code == 400
+    assert hits == []
+    
+    response = client.post('/remove-background', headers=API_HEADERS, data={
+        'url': server + '/image.jpg',
+        'file': (io.BytesIO(jpeg_bytes()), 'a.jpg'),
+    })
+    assert response.status_code == 400
+    assert hits == []
+
+
+@pytest.mark.parametrize('extra, limit', [({}, app.BATCH_MAX_FILES), ({'stream': 'zip'}, app.BATCH_MAX_FILES),
+                                          ({'async': 'true'}, app.BATCH_MAX_FILES_ASYNC)])
+def test_batch_rejects_urls_over_the_mode_limit_before_fetching(server, client, hits, extra, limit):
+    manifest = '\n'.join(f'{server}/image{i}.jpg' for i in range(limit + 1)).encode()
+    response = client.post('/batch-remove', headers=API_HEADERS, data={
+        'manifest': (io.BytesIO(manifest), 'urls.csv'), **extra,
+    })
+    assert response.status_code == 400
+    assert str(limit) in response.json['error']
+    assert hits == []
+
+
+def test_batch_reports_fetch_failures(server, client, monkeypatch):
+    # Nenhuma imagem chega ao modelo: o arquivo do modelo não precisa estar baixado
+    monkeypatch.setattr(app, 'model_downloaded', lambda model_name: True)
+    response = client.post('/batch-remove', data={'urls': [server + '/missing.jpg']}, headers=API_HEADERS)
+    assert response.status_code == 200
+    assert response.json['failed_files'] == [
+        {'original_name': server + '/missing.jpg', 'error': 'Não foi possível baixar a imagem: HTTP 404'}
+    ]
+
+
+def test_manifest_errors_are_client_errors(client):
+    response = client.post('/batch-remove', headers=API_HEADERS, data={
+        'manifest': (io.BytesIO(json.dumps([1]).encode()), 'urls.json'),
+    })
+    assert response.status_code == 400
@@ -0,0 +1,121 @@
+import os
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return app.ResultStorage(str(tmp_path / 'processed'), str(tmp_path / 'storage.db'), ttl_hours=1, max_bytes=1000)
+
+
+def save(storage, file_id, data):
+    path, content_hash = storage.save(file_id, data, 'png')
+    # created_at distintos: a cota remove pela ordem de criação
+    time.sleep(0.01)
+    return path
+
+
+def test_identical_results_share_one_file(storage):
+    first = save(storage, 'a', b'x' * 100)
+    second = save(storage, 'b', b'x' * 100)
+    assert first == second
+    assert storage.lookup('b')['path'] == first
+    assert storage.lookup('a')['content_hash'] == storage.lookup('b')['content_hash']
+
+
+def test_alias_keeps_file_until_last_id_is_deleted(storage):
+    path = save(storage, 'a', b'x' * 100)
+    save(storage, 'b', b'x' * 100)
+    conn = app.open_sqlite(storage.db_path)
+    try:
+        assert storage._delete(conn, 'id = ?', ('a',)) == 1
+        assert os.path.exists(path)
+        assert storage.lookup('b') is not None
+        assert storage._delete(conn, 'id = ?', ('b',)) == 1
+    finally:
+        conn.close()
+    assert not os.path.exists(path)
+
+
+def test_quota_evicts_oldest_files(storage):
+    paths = [save(storage, str(index), bytes([index]) * 300) for index in range(3)]
+    assert all(os.path.exists(path) for path in paths)
+    # 1200 bytes passam do limite de 1000: os mais antigos saem até ficar em 90% (900)
+    paths.append(save(storage, '3', b'\x03' * 300))
+    assert storage.lookup('0') is None and not os.path.exists(paths[0])
+    assert all(storage.lookup(str(index)) is not None and os.path.exists(paths[index]) for index in (1, 2, 3))
+
+
+def test_quota_counts_aliased_files_once(storage):
+    save(storage, 'a', b'x' * 400)
+    save(storage, 'b', b'x' * 400)
+    save(storage, 'c', b'y' * 400)
+    assert all(storage.lookup(file_id) is not None for file_id in 'abc')
+
+
+def test_delete_expired(storage):
+    path = save(storage, 'a', b'x' * 100)
+    conn = app.open_sqlite(storage.db_path)
+    try:
+        conn.execute('UPDATE files SET expires_at = ?', (time.time() - 1,))
+    finally:
+        conn.close()
+    storage.delete_expired()
+    assert storage.lookup('a') is None
+    assert not os.path.exists(path)
+
+
+def test_legacy_flat_files_expire(tmp_path):
+    old = tmp_path / 'old_output.png'
+    recent = tmp_path / 'recent_output.png'
+    other = tmp_path / 'storage.db'
+    for path in (old, recent, other):
+        path.write_bytes(b'x')
+    two_days_ago = time.time() - 48 * 3600
+    os.utime(old, (two_days_ago, two_days_ago))
+    os.utime(other, (two_days_ago, two_days_ago))
+    assert app.delete_legacy_files(str(tmp_path), '_output', 24) == 1
+    assert not old.exists()
+    assert recent.exists() and other.exists()
+
+
+def test_result_cache_disk_quota_is_shared_between_workers(tmp_path):
+    # Dois workers com a mesma pasta: a soma das gravações dispara a remoção
+    workers = [app.ResultCache(str(tmp_path), 0, 1000) for _ in range(2)]
+    for index in range(4):
+        workers[index % 2].put(str(index), bytes([index]) * 300)
+        time.sleep(0.01)
+    entries, total = workers[0]._scan_disk()
+    assert total <= 1000 and len(entries) == 3
+    assert workers[1].get('0') is None
+    assert workers[0].get('3') == b'\x03' * 300
+
+
+@pytest.fixture
+def rate_limit_storage(tmp_path):
+    return app.SQLiteRateLimitStorage(f'sqlite:///{tmp_path}/ratelimit.db')
+
+
+def test_rate_limit_counters(rate_limit_storage):
+    assert rate_limit_storage.incr('key', 60) == 1
+    assert rate_limit_storage.incr('key', 60, amount=3) == 4
+    assert rate_limit_storage.get('key') == 4
+    assert rate_limit_storage.get('other') == 0
+    assert time.time() < rate_limit_storage.get_expiry('key') <= time.time() + 60
+    rate_limit_storage.clear('key')
+    assert rate_limit_storage.get('key') == 0
+
+
+def test_rate_limit_window_expires(rate_limit_storage):
+    rate_limit_storage.incr('key', 0.2, amount=5)
+    time.sleep(0.3)
+    assert rate_limit_storage.get('key') == 0
+    # A janela vencida recomeça do zero
+    assert rate_limit_storage.incr('key', 60) == 1
+    assert rate_limit_storage.delete_expired() == 0
+    rate_limit_storage.incr('old', 0.1)
+    time.sleep(0.2)
+    assert rate_limit_storage.delete_expired() == 1
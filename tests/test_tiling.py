@@ -0,0 +1,47 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('size', [(8000, 50), (3000, 100), (8000, 1023), (50, 8000)])
+def test_thin_images_are_not_tiled(size):
+    assert not app.uses_tiled_inference(*size)
+
+
+# Sem o limite da sobreposição, o passo caía para 1 pixel: 7951 e 2901 blocos
+@pytest.mark.parametrize('size, limit', [
+    ((8000, 50), 215),
+    ((3000, 100), 40),
+    ((8000, 8000), 100),
+    ((4000, 3000), 20),
+])
+def test_tile_count_is_bounded(size, limit):
+    boxes = app._tile_boxes(*size)
+    assert 0 < len(boxes) <= limit
+
+
+def test_tiles_cover_the_image():
+    width, height = 4000, 3000
+    boxes = app._tile_boxes(width, height)
+    assert app.uses_tiled_inference(width, height)
+    assert all(x1 - x0 == app.TILE_SIZE and y1 - y0 == app.TILE_SIZE for x0, y0, x1, y1 in boxes)
+    assert max(x1 for _, _, x1, _ in boxes) == width
+    assert max(y1 for _, _, _, y1 in boxes) == height
+    assert min(x0 for x0, _, _, _ in boxes) == 0 and min(y0 for _, y0, _, _ in boxes) == 0
+
+
+def test_overlap_is_limited_to_a_quarter_of_the_tile():
+    assert app._tile_overlap(1024) == app.TILE_OVERLAP
+    assert app._tile_overlap(100) == 25
+
+
+def test_blend_weights_ramp_only_on_inner_edges():
+    # Bloco no canto superior esquerdo de uma imagem 100x100, com vizinhos à direita e abaixo
+    weights = app._tile_weights((0, 0, 60, 60), 100, 100, overlap=10)
+    assert weights.shape == (60, 60)
+    assert weights[0, 0] == 1
+    assert weights[30, 30] == 1
+    assert 0 < weights[30, -1] < weights[30, -10] < 1
+    assert 0 < weights[-1, 30] < 1
+    # Bloco que cobre a imagem inteira não tem bordas internas
+    assert app._tile_weights((0, 0, 100, 100), 100, 100, overlap=10).min() == 1